@@ -1,205 +1,543 @@
 """All functionality related to interactions with AIB online interface."""
 
+import abc
 import csv
 import datetime
+import decimal
+import fnmatch
+import functools
+import hashlib
 import logging
+import random
 import re
 import tempfile
+import threading
 import time
 
-import dateutil.parser as dparser
-import mechanicalsoup
+# Browser and HTTP libraries, and modules using them, are imported by Aib
+# itself: they're slow to import, and not needed for parsing CSV exports.
 
+# Parser of bank's pages: lxml is much quicker than html.parser on the large
+# account pages.
+PAGE_PARSER = 'lxml'
 
+# 2FA polling: first poll comes quickly, then they slow down, so that we're
+# neither late to notice the approval nor flooding the bank with requests.
+_TFA_POLL_INITIAL = 0.5
+_TFA_POLL_BACKOFF = 1.5
+_TFA_POLL_MAX = 2
+_TFA_TIMEOUT = 300
+
+_DATE_RE = re.compile(r'\s*(\d\d?)/(\d\d?)/(\d\d\d\d)\s*')
+
+
+@functools.lru_cache(maxsize=4096)
 def _to_date(text):
     # AIB CSV export format: DD/MM/YYYY
-    return dparser.parse(text, dayfirst=True, yearfirst=False)
+    # Exports repeat the same few dates over and over, hence the cache. Anything
+    # that doesn't look like the usual format is left for dateutil to figure out.
+    match = _DATE_RE.fullmatch(text)
+    if match:
+        day, month, year = match.groups()
+        try:
+            return datetime.date(int(year), int(month), int(day))
+        except ValueError:
+            pass
+    import dateutil.parser as dparser
+
+    return dparser.parse(text, dayfirst=True, yearfirst=False).date()
 
 
-def _to_value(text):
+def _to_amount(text):
     tmp = text.strip().replace(',', '')
+    if not tmp:
+        return None
     if tmp[-3:] == ' DR':
-        return '-' + tmp[:-3]
-    return tmp
+        tmp = '-' + tmp[:-3]
+    return decimal.Decimal(tmp)
+
+
+def amount_text(amount):
+    """Returns amount as text to be stored, None if it's unknown."""
+    return None if amount is None else str(amount)
+
 
+class Operation:
+    """Single transaction on an account.
 
-def _csv2account(csv_data, acc):
-    transactions = list(csv_data)
-    if not transactions:
+    Amounts are Decimals (None if the column was empty), timestamp is a date.
+    """
+
+    __slots__ = ('timestamp', 'description', 'debit', 'credit')
+
+    def __init__(self, timestamp, description, debit=None, credit=None):
+        self.timestamp = timestamp
+        self.description = description
+        self.debit = debit
+        self.credit = credit
+
+    def __repr__(self):
+        return 'Operation(%r, %r, debit=%r, credit=%r)' % (
+            self.timestamp,
+            self.description,
+            self.debit,
+            self.credit,
+        )
+
+
+class Account:
+    """Account summary along with its operations.
+
+    Type is either 'checking' or 'credit'; balance is only known for the former.
+    Operations are an iterable of Operation objects; csv is the raw export,
+    as a file object. Fingerprint identifies the state of the account summary
+    it was scraped from.
+    """
+
+    __slots__ = (
+        'account_id',
+        'available',
+        'currency',
+        'bank_id',
+        'report_date',
+        'type',
+        'balance',
+        'operations',
+        'csv',
+        'fingerprint',
+    )
+
+    def __init__(
+        self,
+        account_id,
+        available=None,
+        currency='EUR',
+        bank_id='AIB',
+        report_date=None,
+    ):
+        self.account_id = account_id
+        self.available = available
+        self.currency = currency
+        self.bank_id = bank_id
+        self.report_date = report_date or datetime.datetime.now()
+        self.type = None
+        self.balance = None
+        self.operations = ()
+        self.csv = None
+        self.fingerprint = None
+
+    def __repr__(self):
+        return 'Account(%r, type=%r)' % (self.account_id, self.type)
+
+
+def _to_operation(transaction, account_type):
+    # The mysterious story of 'Description' field in CSV exports continues!
+    # Now the columns differ between CC and current account, on top of the
+    # implemented bugs :(
+    if account_type == 'credit':
+        desc = transaction['Description']
+        if len(desc) > 18 and desc[18] == ' ':
+            desc = desc[:18] + desc[19:]
+    else:
+        descriptions = []
+        for i in [1, 2, 3]:
+            descriptions.append(transaction['Description%s' % i].strip())
+        desc = ' '.join(filter(bool, descriptions))
+    return Operation(
+        _to_date(transaction['Posted Transactions Date']),
+        desc,
+        _to_amount(transaction['Debit Amount']),
+        _to_amount(transaction['Credit Amount']),
+    )
+
+
+class _CsvOperations:
+    """Operations of an account, parsed lazily out of its CSV export.
+
+    Every iteration re-reads the export from the start, so only one operation
+    is held in memory at a time. Don't iterate over the same object from two
+    places at once, as they share the underlying file position.
+    """
+
+    def __init__(self, csv_file, account_type):
+        self.csv_file = csv_file
+        self.account_type = account_type
+
+    def __iter__(self):
+        self.csv_file.seek(0)
+        for transaction in csv.DictReader(self.csv_file, skipinitialspace=True):
+            yield _to_operation(transaction, self.account_type)
+
+
+def _spool_lines(lines):
+    """Saves lines of text to an anonymous temporary file, returns it."""
+    spool = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+    for number, line in enumerate(lines):
+        if number:
+            spool.write('\n')
+        spool.write(line)
+    spool.seek(0)
+    return spool
+
+
+def _csv2account(csv_file, acc):
+    transactions = csv.DictReader(csv_file, skipinitialspace=True)
+    if not transactions.fieldnames:
         return None
-    if 'Masked Card Number' in transactions[0]:
-        acc['type'] = 'credit'
+    # Exports narrowed down to recent dates can have no transactions at all,
+    # but their header still tells the account type.
+    if 'Masked Card Number' in transactions.fieldnames:
+        acc.type = 'credit'
     else:
-        acc['type'] = 'checking'
-        acc['balance'] = transactions[-1].get('Balance', 0)
-    operations = []
-    for transaction in transactions:
-        operation = {}
-        operation['timestamp'] = _to_date(transaction['Posted Transactions Date'])
-        # The mysterious story of 'Description' field in CSV exports continues!
-        # Now the columns differ between CC and current account, on top of the
-        # implemented bugs :(
-        if acc['type'] == 'credit':
-            desc = transaction['Description']
-            if len(desc) > 18 and desc[18] == ' ':
-                desc = desc[:18] + desc[19:]
-        else:
-            descriptions = []
-            for i in [1, 2, 3]:
-                descriptions.append(transaction['Description%s' % i].strip())
-            desc = ' '.join(filter(bool, descriptions))
-        operation['description'] = desc
-        operation['debit'] = _to_value(transaction['Debit Amount'])
-        operation['credit'] = _to_value(transaction['Credit Amount'])
-        operations.append(operation)
-    acc['operations'] = operations
+        acc.type = 'checking'
+        last = None
+        for last in transactions:
+            pass
+        # Balance is only known from the last transaction.
+        if last is not None:
+            acc.balance = _to_amount(last.get('Balance') or '0')
+    acc.operations = _CsvOperations(csv_file, acc.type)
+    acc.csv = csv_file
     return acc
 
 
-class CleansingFormatter(logging.Formatter):
-    """Logging formatter that scrubs monetary values out."""
+_SAVINGS_RE = re.compile('SAVINGS')
+# Start of the date range on historical export forms, eg. 'fromDate'.
+_START_DATE_RE = re.compile('(from|start).*date|date.*(from|start)', re.IGNORECASE)
 
-    def __init__(self, fmt=None, datefmt=None):
-        self.amount_re = re.compile(r'(?:\d+,)*\d+\.\d+(?: DR)?')
-        self.date_re = re.compile(r'\d\d/\d\d/\d\d')
-        self.description_re = re.compile('<td>(?!dd/mm/yy).+</td>')
+
+@functools.lru_cache(maxsize=None)
+def _js_value_re(varname):
+    return re.compile(rb"%s = '([^']+)';" % re.escape(varname.encode('ascii')))
+
+
+def _poll_intervals():
+    """Yields intervals between 2FA polls: growing exponentially, jittered."""
+    interval = _TFA_POLL_INITIAL
+    while True:
+        yield interval * random.uniform(0.8, 1.2)
+        interval = min(interval * _TFA_POLL_BACKOFF, _TFA_POLL_MAX)
+
+
+class AccountFilter:
+    """Decides which accounts are worth fetching.
+
+    Patterns are shell-style wildcards matched against account IDs. Types are
+    matched, case-insensitively, against the text of the account's summary
+    button on the main page, eg. 'CURRENT' or 'VISA'. Empty include lists let
+    everything in; excludes win over includes.
+    """
+
+    def __init__(self, include=(), exclude=(), include_types=(), exclude_types=()):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.include_types = [t.upper() for t in include_types]
+        self.exclude_types = [t.upper() for t in exclude_types]
+
+    def __call__(self, account_id, summary):
+        summary = summary.upper()
+        if self.include and not any(
+            fnmatch.fnmatchcase(account_id, p) for p in self.include
+        ):
+            return False
+        if self.include_types and not any(t in summary for t in self.include_types):
+            return False
+        if any(fnmatch.fnmatchcase(account_id, p) for p in self.exclude):
+            return False
+        return not any(t in summary for t in self.exclude_types)
+
+
+# Scrubbing rules of CleansingFormatter: (pattern, replacement) pairs. Table
+# cells are descriptions, unless they hold a date.
+SCRUB_RULES = (
+    (r'<td>(?!\d\d/\d\d/\d\d|dd/mm/yy).+</td>', '<td>dummy description</td>'),
+    (r'(?:\d+,)*\d+\.\d+(?: DR)?', 'X.XX'),
+    (r'\d\d/\d\d/\d\d', 'dd/mm/yy'),
+)
+# Character class matching first characters of everything SCRUB_RULES match.
+SCRUB_STARTS = r'[<\d]'
+
+
+class CleansingFormatter(logging.Formatter):
+    """Logging formatter that scrubs monetary values out.
+
+    Records are formatted first, so that their arguments and tracebacks are
+    scrubbed too, and records themselves are left untouched for other
+    handlers. All rules are applied in a single pass over the text; where
+    matches of several rules start at the same place, the earlier rule wins.
+    Replacements are plain text. If starts is given, the regex engine skips
+    straight to characters it matches, which is much quicker; it has to match
+    first characters of everything the rules do. It's SCRUB_STARTS for the
+    default rules.
+    """
+
+    def __init__(self, fmt=None, datefmt=None, rules=SCRUB_RULES, starts=None):
+        if starts is None and rules is SCRUB_RULES:
+            starts = SCRUB_STARTS
+        self.replacements = {}
+        patterns = []
+        for number, (pattern, replacement) in enumerate(rules):
+            name = '_%d' % number
+            patterns.append('(?P<%s>%s)' % (name, pattern))
+            self.replacements[name] = replacement
+        pattern = '|'.join(patterns)
+        if starts:
+            pattern = '(?=%s)(?:%s)' % (starts, pattern)
+        self.rules_re = re.compile(pattern)
         logging.Formatter.__init__(self, fmt, datefmt)
 
-    def format(self, record):
-        tmp = record.msg
-        tmp = self.amount_re.sub('X.XX', tmp)
-        tmp = self.date_re.sub('dd/mm/yy', tmp)
-        tmp = self.description_re.sub('<td>dummy description</td>', tmp)
-        record.msg = tmp
-        return logging.Formatter.format(self, record)
+    def _replacement(self, match):
+        return self.replacements[match.lastgroup]
 
+    def scrub(self, text):
+        """Returns text with amounts, dates and descriptions replaced."""
+        return self.rules_re.sub(self._replacement, text)
 
-class Aib:
-    """Automated browser interacting with AIB online interface."""
+    def format(self, record):
+        return self.scrub(logging.Formatter.format(self, record))
+
+
+def _summary_accounts(page, account_filter, is_unchanged, logger):
+    """Returns accounts from the main page worth fetching, by ID.
+
+    Also returns IDs of accounts skipped as unchanged. See Aib for what
+    account_filter and is_unchanged are.
+    """
+    accounts = {}
+    unchanged = []
+    for account_line in page.find_all('button', class_='account-button'):
+        account_name = account_line.find('div', attrs={'class': 'account-name'})
+        account_amount = account_line.find('span', attrs={'class': 'a-amount'})
+        if not account_name:
+            continue
+
+        # Skip pension and saving accounts
+        if account_line.find(string=_SAVINGS_RE):
+            continue
+
+        account_id = account_name.get_text(strip=True)
+        summary = account_line.get_text(' ', strip=True)
+        if account_filter and not account_filter(account_id, summary):
+            logger.debug('skipping account %s excluded by filters', account_id)
+            continue
+        # Balance and pending status are all in the summary; a hash of it
+        # tells whether anything has happened since the last export,
+        # without keeping the balance around.
+        fingerprint = hashlib.sha256(summary.encode('utf-8')).hexdigest()
+        if is_unchanged and is_unchanged(account_id, fingerprint):
+            logger.debug('skipping account %s which is unchanged', account_id)
+            unchanged.append(account_id)
+            continue
+
+        account = Account(
+            account_id,
+            available=_to_amount(account_amount.get_text(strip=True)),
+        )
+        account.fingerprint = fingerprint
+        accounts[account.account_id] = account
+    return accounts, unchanged
+
+
+def _set_start_date(form, since):
+    """Sets start of the export date range, returns False if there's none."""
+    fields = form.form.find_all('input', attrs={'name': _START_DATE_RE})
+    for field in fields:
+        form[field['name']] = since.strftime('%d/%m/%Y')
+    return bool(fields)
+
+
+def _extract_value(content, varname):
+    """Greps content for something that looks like a JS assignment, returns value."""
+    # Luckily the JS code isn't minified.
+    mangled_value = _js_value_re(varname).search(content).group(1)
+    value = (
+        mangled_value.replace(b'\\/', b'/')
+        .replace(b'\\-', b'-')
+        .decode('unicode-escape')
+    )
+    # I feel dirty now. >_<
+    return value
+
+
+# Debug log is set up once per process, by the first Aib object that needs it;
+# later ones (other users, re-logins in serve mode) share it.
+_debug_logger = None
+_debug_logger_lock = threading.Lock()
+
+
+def _make_logger(chatter):
+    global _debug_logger
+    if not chatter['debug']:
+        logging.disable(logging.DEBUG)
+        return logging.getLogger(None)
+
+    import atexit
+    import queue
+    from logging.handlers import QueueHandler, QueueListener
+
+    with _debug_logger_lock:
+        if _debug_logger is not None:
+            return _debug_logger
+        # make a directory for debugging output
+        debugdir = tempfile.mkdtemp(prefix='aib2ofx_')
+        print('WARNING: putting *sensitive* debug data in %s' % debugdir)
+        logger = logging.getLogger('mechanize')
+        logfile = logging.FileHandler(debugdir + '/mechanize.log', 'w')
+        formatter = CleansingFormatter('%(asctime)s\n%(message)s')
+        logfile.setFormatter(formatter)
+        # Scrubbing and writing happen on the listener's thread, so that
+        # logging doesn't hold up scraping; whatever is left in the queue is
+        # written out at exit.
+        records = queue.SimpleQueue()
+        listener = QueueListener(records, logfile)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(QueueHandler(records))
+        logger.setLevel(logging.DEBUG)
+        _debug_logger = logger
+        return logger
+
+
+class Site(abc.ABC):
+    """Pages of AIB's online interface, and the way through them.
+
+    The page flow is written once, as coroutines driving self.pages, for both
+    backends: Aib runs it on top of mechanicalsoup, aio.AsyncAib on top of
+    httpx. Subclasses provide self.pages, along with _timeout() and _sleep(),
+    and the public methods running the flow.
+    """
+
+    def __init__(
+        self,
+        logindata,
+        chatter,
+        tfa_timeout=None,
+        tracer=None,
+        account_filter=None,
+        unchanged=None,
+        since=None,
+    ):
+        """Sets up the common state; nothing is requested yet.
+
+        account_filter, if given, is called with account ID and summary text
+        of every account; those it returns False for are never requested.
+        unchanged, if given, is called with account ID and fingerprint of its
+        summary; accounts it returns True for are skipped as well, and listed
+        in self.unchanged. since, if given, is called with account ID and
+        returns the earliest date worth exporting for it, or None.
+        """
+        from aib2ofx import trace
 
-    def __init__(self, logindata, chatter):
         self.logindata = logindata
-        if chatter['debug']:
-            # make a directory for debugging output
-            debugdir = tempfile.mkdtemp(prefix='aib2ofx_')
-            print('WARNING: putting *sensitive* debug data in %s' % debugdir)
-            self.logger = logging.getLogger('mechanize')
-            logfile = logging.FileHandler(debugdir + '/mechanize.log', 'w')
-            formatter = CleansingFormatter('%(asctime)s\n%(message)s')
-            logfile.setFormatter(formatter)
-            self.logger.addHandler(logfile)
-            self.logger.setLevel(logging.DEBUG)
-        else:
-            logging.disable(logging.DEBUG)
-            self.logger = logging.getLogger(None)
-        self.browser = mechanicalsoup.StatefulBrowser()
+        self.since = since
+        self.account_filter = account_filter
+        self.is_unchanged = unchanged
+        self.unchanged = []
+        self.tfa_timeout = tfa_timeout or _TFA_TIMEOUT
+        self.tfa_stats = None
+        self.accounts_url = None
+        self.logger = _make_logger(chatter)
+        self.tracer = tracer or trace.Tracer()
+        self.pages = None
         self.login_done = False
         self.data = {}
-        self.csv = {}
-
-    def extract_value(self, varname):
-        """Greps the page content for something that looks like a JS assignment, returns value."""
-        response = str(self.browser.page)
-        # Luckily the JS code isn't minified.
-        regex = re.compile("%s = '([^']+)';" % varname)
-        mangled_value = regex.search(response).group(1)
-        value = (
-            mangled_value.replace('\\/', '/')
-            .replace('\\-', '-')
-            .encode('latin1')
-            .decode('unicode-escape')
-        )
-        # I feel dirty now. >_<
-        return value
 
-    def login(self):
-        """Go through the login process."""
-        brw = self.browser
+    @abc.abstractmethod
+    def _timeout(self, request_class):
+        """Returns timeout for a class of requests, in the backend's terms."""
+
+    @abc.abstractmethod
+    async def _sleep(self, seconds):
+        """Waits for given number of seconds, in the backend's terms."""
+
+    async def _login(self):
+        brw = self.pages
 
         # Entry page.
         self.logger.debug('Requesting first login page.')
-        brw.open('https://onlinebanking.aib.ie/inet/roi/login.htm')
+        await brw.open('https://onlinebanking.aib.ie/inet/roi/login.htm')
         brw.select_form(selector='#loginCiamForm')
         self.logger.debug('Clicking large CONTINUE button on the entry page.')
         # Note: response code will be 401, as we haven't authorized yet.
-        response = brw.submit_selected()
+        # We only need a couple of JS values out of the response, so there's no
+        # point in parsing it.
+        response = await brw.submit_unparsed()
         assert response.status_code == 401
 
         # Redirect page.
         # This redirect is pure javascript, so we need to extract the target URL by hand.
-        url = self.extract_value('window.location')
+        url = _extract_value(response.content, 'window.location')
         # We're also saving one value that would be saved in session storage in a modern browser.
-        encoded_post_params = self.extract_value('encodedPostParams')
+        encoded_post_params = _extract_value(response.content, 'encodedPostParams')
         self.logger.debug('Bouncing through the interstitial.')
-        response = brw.open(url, headers={'Referer': response.url})
+        with self.tracer.span('login.interstitial'):
+            response = await brw.open(url, headers={'Referer': str(response.url)})
 
         # Actual login form.
         brw.select_form()
         brw['pf.username'] = self.logindata['regNumber']
         brw['pf.pass'] = self.logindata['pin']
         self.logger.debug('Submitting login form.')
-        brw.submit_selected()
+        await brw.submit_selected()
 
         # Wait for 2FA on phone
-        tfa_done = False
-        while not tfa_done:
-            brw.select_form('#finalizeForm')
-            response = brw.submit_selected(update_state=False)
-            if response.content == b'approved':
-                tfa_done = True
-            elif response.content != b'in_progress':
-                raise RuntimeError(
-                    'unexpected answer during 2FA auth: %s' % response.content
-                )
-            time.sleep(1)
+        start = time.monotonic()
+        intervals = _poll_intervals()
+        polls = 0
+        with self.tracer.span('login.2fa') as event:
+            while True:
+                brw.select_form('#finalizeForm')
+                response = await brw.submit_unparsed(timeout=self._timeout('poll'))
+                polls += 1
+                event['polls'] = polls
+                if response.content == b'approved':
+                    break
+                elif response.content != b'in_progress':
+                    raise RuntimeError(
+                        'unexpected answer during 2FA auth: %s' % response.content
+                    )
+                waited = time.monotonic() - start
+                if waited >= self.tfa_timeout:
+                    raise TimeoutError(
+                        '2FA not approved within %d seconds' % self.tfa_timeout
+                    )
+                await self._sleep(min(next(intervals), self.tfa_timeout - waited))
+        self.tfa_stats = {'polls': polls, 'latency': time.monotonic() - start}
+        self.logger.debug(
+            '2FA approved after %.1fs and %d polls.',
+            self.tfa_stats['latency'],
+            polls,
+        )
 
         # Forward to normal interface.
         brw.select_form('#finalizeForm')
-        response = brw.submit_selected()
+        response = await brw.submit_selected()
         # This form is empty after page loads, fields are added by JS.
         form = brw.select_form(nr=0)
-        form.new_control('hidden', 'state', self.extract_value('state.value'))
-        form.new_control('hidden', 'nonce', self.extract_value('encodedNonce'))
+        form.new_control(
+            'hidden', 'state', _extract_value(response.content, 'state.value')
+        )
+        form.new_control(
+            'hidden', 'nonce', _extract_value(response.content, 'encodedNonce')
+        )
         form.new_control('hidden', 'postParams', encoded_post_params)
-        response = brw.submit_selected()
+        response = await brw.submit_selected()
         assert response.status_code == 200
         brw.select_form(nr=0)
-        response = brw.submit_selected()
+        response = await brw.submit_selected()
         assert response.status_code == 200
 
         # mark login as done
         if brw.page.find(string='My Accounts'):
             self.login_done = True
+            self.accounts_url = brw.url
 
-    def get_data(self):
-        """Download data for all accounts."""
-        if not self.login_done:
-            self.login()
-
-        brw = self.browser
-        self.data = {}
+    async def _get_data(self):
+        brw = self.pages
         # parse totals
-        main_page = brw.page
-        for account_line in main_page.find_all(
-            'button', attrs={'class': 'account-button'}
-        ):
-            account_name = account_line.find('div', attrs={'class': 'account-name'})
-            account_amount = account_line.find('span', attrs={'class': 'a-amount'})
-            if not account_name:
-                continue
-
-            # Skip pension and saving accounts
-            if account_line.find(text=re.compile('SAVINGS')):
-                continue
-
-            account = {}
-            account['accountId'] = account_name.get_text(strip=True)
-            account['available'] = _to_value(account_amount.get_text(strip=True))
-            account['currency'] = 'EUR'
-            account['bankId'] = 'AIB'
-            account['reportDate'] = datetime.datetime.now()
-
-            self.data[account['accountId']] = account
+        self.data, self.unchanged = _summary_accounts(
+            brw.page, self.account_filter, self.is_unchanged, self.logger
+        )
 
         # parse transactions
         #
@@ -218,16 +556,17 @@ class Aib:
         # account, switch to historical transactions and iterate there. This
         # WILL fail if the first account doesn't have 'Historical' button :(
         self.logger.debug('Switching to historical transaction listing.')
-        # Click 'Accounts > Transactions' in the top menu. This should bring up
-        # first account's "Recent Transactions" page. This is usually the
-        # current account, which has 'Historical' button.
-        brw.select_form('#statement_form_id')
-        brw.submit_selected()
-        # Click 'Historical' button.
-        brw.select_form('#historicalTransactionsCommand')
-        brw.submit_selected()
+        with self.tracer.span('get_data.historical'):
+            # Click 'Accounts > Transactions' in the top menu. This should bring
+            # up first account's "Recent Transactions" page. This is usually the
+            # current account, which has 'Historical' button.
+            brw.select_form('#statement_form_id')
+            await brw.submit_selected()
+            # Click 'Historical' button.
+            brw.select_form('#historicalTransactionsCommand')
+            await brw.submit_selected()
         # We should be on the 'Historical Transactions' page.
-        assert brw.page.find(string='Historical Transactions') != None
+        assert brw.page.find(string='Historical Transactions') is not None
 
         # Interrogate the account dropdown.
         brw.select_form('#hForm')
@@ -238,58 +577,307 @@ class Aib:
         for account in list(self.data):
             if account not in accounts_on_page.keys():
                 self.logger.debug(
-                    'skipping account %s which is absent on historical'
+                    'skipping account %s which is absent on historical '
                     'transactions page',
                     account,
                 )
                 del self.data[account]
                 continue
 
-            # get account's page
-            self.logger.debug('Requesting transactions for %s.', account)
-            brw.select_form('#hForm')
-            brw['dsAccountIndex'] = accounts_on_page[account]
-            brw.submit_selected()
-
-            # click the export button
-            form = brw.select_form('#historicalTransactionsCommand')
-            # Some accounts (eg. freshly opened ones) have export facility
-            # disabled. Skip them.
-            if form.form.find(attrs={'name': 'export'}).get('value') == 'false':
-                self.logger.debug(
-                    'skipping account %s which has its "Export" button' 'disabled',
-                    account,
-                )
-                del self.data[account]
-                continue
-            brw.submit_selected()
+            with self.tracer.span('get_data.account'):
+                await self._get_account(account, accounts_on_page[account])
 
-            # confirm the export request
-            brw.select_form('#historicalTransactionsCommand')
-            response = brw.submit_selected(update_state=False)
-            response_lines = [line for line in response.iter_lines(decode_unicode=True)]
-            # filename = account.replace(' ', '-').lower()
-            # filename = f'{datetime.date.today().isoformat()}-{filename}.csv'
-            # fd = open(filename, mode='w')
-            # fd.writelines(f'{line}\n' for line in response_lines)
-            # fd.close()
-            csv_data = csv.DictReader(response_lines, skipinitialspace=True)
-            self.data[account] = _csv2account(csv_data, self.data[account])
-            self.data[account]['csv'] = response_lines
-
-            # go back to the list of accounts
-            brw.select_form('#historicaltransactions_form_id')
-            brw.submit_selected()
+    async def _get_account(self, account, option):
+        """Download transactions of a single account from historical listing."""
+        brw = self.pages
+
+        # get account's page
+        self.logger.debug('Requesting transactions for %s.', account)
+        brw.select_form('#hForm')
+        brw['dsAccountIndex'] = option
+        await brw.submit_selected()
+
+        # click the export button
+        form = brw.select_form('#historicalTransactionsCommand')
+        # Some accounts (eg. freshly opened ones) have export facility
+        # disabled. Skip them.
+        if form.form.find(attrs={'name': 'export'}).get('value') == 'false':
+            self.logger.debug(
+                'skipping account %s which has its "Export" button disabled',
+                account,
+            )
+            del self.data[account]
+            return
+        since = self.since(account) if self.since else None
+        narrowed = since and _set_start_date(form, since)
+        await brw.submit_selected()
+
+        # confirm the export request
+        form = brw.select_form('#historicalTransactionsCommand')
+        if since and not narrowed:
+            narrowed = _set_start_date(form, since)
+        if since and not narrowed:
+            self.logger.debug(
+                'no date range fields for %s, exporting default range', account
+            )
+        # The export can be large; stream it straight to disk instead of
+        # keeping it in memory.
+        with self.tracer.span('get_data.export') as event:
+            csv_file, event['status'], event['bytes'] = await brw.download(
+                timeout=self._timeout('export')
+            )
+        with self.tracer.span('csv2account'):
+            self.data[account] = _csv2account(csv_file, self.data[account])
+
+        # go back to the list of accounts
+        brw.select_form('#historicaltransactions_form_id')
+        await brw.submit_selected()
+
+    async def _logout(self):
+        self.logger.debug('Logging out.')
+        brw = self.pages
+        brw.select_form('#formLogout')
+        # Nothing to do on the page after logging out, other than checking it.
+        response = await brw.submit_unparsed()
+        if b'Logged Out' not in response.content:
+            raise Exception('Logout failed!')
 
     def getdata(self):
         """Returns data acquired from online interface."""
         return self.data
 
+
+class _Pages:
+    """mechanicalsoup.StatefulBrowser, as Site's page flow expects it.
+
+    Its coroutines never wait for anything, so the flow runs on it without an
+    event loop; see _run().
+    """
+
+    def __init__(self, browser):
+        self.browser = browser
+
+    @property
+    def page(self):
+        return self.browser.page
+
+    @property
+    def url(self):
+        return self.browser.url
+
+    @property
+    def form(self):
+        return self.browser.form
+
+    def select_form(self, selector='form', nr=0):
+        """Selects a form on the current page, returns it."""
+        return self.browser.select_form(selector, nr)
+
+    def __setitem__(self, name, value):
+        self.browser[name] = value
+
+    async def open(self, url, headers=None):
+        """Requests url, and makes the response the current page."""
+        return self.browser.open(url, headers=headers)
+
+    async def submit_selected(self):
+        """Submits the selected form, and makes the response the current page."""
+        return self.browser.submit_selected()
+
+    async def submit_unparsed(self, stream=False, timeout=None):
+        """Submits the selected form, but doesn't parse the response.
+
+        Browser state is left untouched, as with submit_selected(update_state=False).
+        Unlike that, the response body isn't read upfront, so it can be streamed.
+        """
+        brw = self.browser
+        brw.form.choose_submit(None)
+        kwargs = {'stream': stream}
+        # Without a timeout, the transport adapter picks its own.
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        request = brw.get_request_kwargs(
+            brw.form.form, brw.url, headers={'Referer': brw.url}, **kwargs
+        )
+        return brw.session.request(**request)
+
+    async def download(self, timeout=None):
+        """Submits the selected form, saving the response body to a file.
+
+        Returns the file, status of the response and its size in bytes.
+        """
+        response = await self.submit_unparsed(stream=True, timeout=timeout)
+        try:
+            csv_file = _spool_lines(response.iter_lines(decode_unicode=True))
+            return csv_file, response.status_code, response.raw.tell()
+        finally:
+            response.close()
+
+
+def _run(flow):
+    """Runs a coroutine of Site's page flow on _Pages, returns its result."""
+    try:
+        flow.send(None)
+    except StopIteration as stop:
+        return stop.value
+    flow.close()
+    raise RuntimeError('page flow waited for something, outside an event loop')
+
+
+class Aib(Site):
+    """Automated browser interacting with AIB online interface."""
+
+    def __init__(
+        self,
+        logindata,
+        chatter,
+        session_file=None,
+        tfa_timeout=None,
+        tracer=None,
+        account_filter=None,
+        unchanged=None,
+        since=None,
+        timeouts=None,
+    ):
+        """Sets up the browser; nothing is requested yet.
+
+        See Site for most of the arguments. Logged in sessions are kept in
+        session_file, if given. timeouts override transport.TIMEOUTS, by class
+        of requests.
+        """
+        import mechanicalsoup
+
+        from aib2ofx import trace, transport
+
+        super().__init__(
+            logindata, chatter, tfa_timeout, tracer, account_filter, unchanged, since
+        )
+        self.session_file = session_file
+        self.browser = mechanicalsoup.StatefulBrowser(
+            session=trace.TracedSession(self.tracer),
+            soup_config={'features': PAGE_PARSER},
+        )
+        self.browser.session.headers['Accept-Encoding'] = transport.ACCEPT_ENCODING
+        self.pages = _Pages(self.browser)
+        self.adapter = None
+        self.mount(transport.Adapter(timeouts=timeouts))
+
+    def mount(self, adapter):
+        """Makes the browser talk to the bank through given transport adapter."""
+        self.browser.session.mount('https://', adapter)
+        self.adapter = adapter
+
+    def _timeout(self, request_class):
+        from aib2ofx import transport
+
+        # Adapters other than ours (eg. replay ones) get no timeouts.
+        if isinstance(self.adapter, transport.Adapter):
+            return self.adapter.timeout(request_class)
+        return None
+
+    async def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _session_secret(self):
+        # Cached sessions are only as safe as the config file, which is fine:
+        # anyone who can read it can log in anyway.
+        return '%s:%s' % (self.logindata['regNumber'], self.logindata['pin'])
+
+    def restore_session(self):
+        """Picks up a session saved by save_session(), returns True on success."""
+        import requests
+
+        from aib2ofx import session
+
+        saved = session.load(self.session_file, self._session_secret())
+        if not saved:
+            self.logger.debug('Session cache miss: no usable session saved.')
+            return False
+        brw = self.browser
+        for cookie in saved['cookies']:
+            brw.session.cookies.set_cookie(requests.cookies.create_cookie(**cookie))
+        self.logger.debug('Trying saved session.')
+        brw.open(saved['url'])
+        if not brw.page or not brw.page.find(string='My Accounts'):
+            self.logger.debug('Session cache miss: saved session has expired.')
+            brw.session.cookies.clear()
+            session.forget(self.session_file)
+            return False
+        self.logger.debug('Session cache hit.')
+        self.accounts_url = saved['url']
+        self.login_done = True
+        return True
+
+    def save_session(self):
+        """Saves cookies of a logged in session for restore_session() to use."""
+        from aib2ofx import session
+
+        cookies = [
+            {
+                'name': cookie.name,
+                'value': cookie.value,
+                'domain': cookie.domain,
+                'path': cookie.path,
+                'secure': cookie.secure,
+                'expires': cookie.expires,
+            }
+            for cookie in self.browser.session.cookies
+        ]
+        session.save(
+            self.session_file,
+            self._session_secret(),
+            {'url': self.accounts_url, 'cookies': cookies},
+        )
+
+    def resume(self):
+        """Goes back to the accounts page after an earlier login.
+
+        Returns True if the session is still valid, and data can be fetched
+        again without logging in.
+        """
+        if not self.login_done:
+            return False
+        brw = self.browser
+        brw.open(self.accounts_url)
+        if brw.page and brw.page.find(string='My Accounts'):
+            self.logger.debug('Resumed earlier session.')
+            return True
+        self.logger.debug('Earlier session has expired.')
+        self.login_done = False
+        return False
+
+    def login(self):
+        """Go through the login process."""
+        with self.tracer.span('login'):
+            if self.session_file and self.restore_session():
+                return
+            _run(self._login())
+            if self.login_done and self.session_file:
+                self.save_session()
+
+    def get_data(self):
+        """Download data for all accounts."""
+        from aib2ofx import transport
+
+        if not self.login_done:
+            self.login()
+        with self.tracer.span('get_data'):
+            _run(self._get_data())
+            # Session cookies could have been refreshed along the way.
+            if self.session_file:
+                self.save_session()
+        if isinstance(self.adapter, transport.Adapter):
+            self.logger.debug(
+                'Transport: %(requests)d requests over %(connections)d connections.',
+                self.adapter.stats(),
+            )
+
     def bye(self):
         """Logs user out of bank's online interface."""
-        self.logger.debug('Logging out.')
-        brw = self.browser
-        brw.select_form('#formLogout')
-        brw.submit_selected()
-        if not brw.page.find(string='Logged Out'):
-            raise Exception('Logout failed!')
+        from aib2ofx import session
+
+        try:
+            _run(self._logout())
+        finally:
+            if self.session_file:
+                session.forget(self.session_file)
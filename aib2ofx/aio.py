@@ -0,0 +1,277 @@
+"""Asynchronous backend: many users scraped at once, on a single event loop.
+
+AsyncAib runs the page flow of aib.Site, same as aib.Aib, but over httpx, so
+that while one user waits for 2FA or a slow export, the others get on with
+theirs. All of them share a Pool: one set of connections, and a limit on
+requests in flight, so the bank doesn't see a burst of them however many users
+there are. The synchronous aib.Aib stays the default, being the one that
+supports session caching and recording.
+"""
+
+import asyncio
+import tempfile
+import urllib.parse
+
+import bs4
+import mechanicalsoup
+
+from aib2ofx import aib, transport
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def check_available():
+    """Raises RuntimeError if the asynchronous backend can't be used."""
+    if httpx is None:
+        raise RuntimeError(
+            'asynchronous backend needs the "httpx" package, '
+            'install aib2ofx[async] to get it'
+        )
+
+
+class _SharedTransport(httpx.AsyncBaseTransport if httpx else object):
+    """Transport that a client closing itself doesn't close for the others."""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        pass
+
+
+class ReplayTransport(httpx.AsyncBaseTransport if httpx else object):
+    """Transport answering requests from a cassette, like replay.ReplayAdapter."""
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+
+    async def handle_async_request(self, request):
+        interaction = self.adapter.next_interaction(request.method, str(request.url))
+        body = interaction['body']
+        return httpx.Response(
+            interaction['status'],
+            headers=interaction['headers'],
+            content=body.encode('latin1') if isinstance(body, str) else body,
+        )
+
+
+class Pool:
+    """Connections and a concurrency limit, shared by many AsyncAib objects.
+
+    limit is the number of requests in flight at any time, across all users;
+    time spent waiting between 2FA polls doesn't count. Failed connections
+    are retried; cookies are kept per user, by their own clients.
+    """
+
+    def __init__(self, limit=4, retries=transport.RETRIES):
+        check_available()
+        self.limit = asyncio.Semaphore(limit)
+        self.transport = httpx.AsyncHTTPTransport(
+            retries=retries,
+            limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+        )
+
+    def timeout(self, request_class, timeouts=None):
+        """Returns httpx timeout for a class of requests.
+
+        timeouts override transport.TIMEOUTS, by class of requests.
+        """
+        seconds = dict(transport.TIMEOUTS, **(timeouts or {}))[request_class]
+        return httpx.Timeout(seconds, connect=transport.CONNECT_TIMEOUT)
+
+    def client(self, own_transport=None):
+        """Returns a new client, with cookies of its own, using the pool.
+
+        Its requests go through own_transport instead of the pool's
+        connections, if given, eg. a ReplayTransport.
+        """
+        return httpx.AsyncClient(
+            transport=own_transport or _SharedTransport(self.transport),
+            timeout=self.timeout('page'),
+            headers={'Accept-Encoding': transport.ACCEPT_ENCODING},
+            follow_redirects=True,
+        )
+
+    async def aclose(self):
+        """Closes all connections."""
+        await self.transport.aclose()
+
+
+class AsyncBrowser:
+    """Just enough of mechanicalsoup.StatefulBrowser for aib.Site, on top of httpx.
+
+    Forms are still mechanicalsoup.Form objects, and requests are built out
+    of them by mechanicalsoup, so they're the same as those of aib.Aib.
+    """
+
+    def __init__(self, client, pool, tracer):
+        self.client = client
+        self.pool = pool
+        self.tracer = tracer
+        self.page = None
+        self.url = None
+        self.form = None
+
+    async def request(self, method, url, stream=False, **kwargs):
+        """Sends a request, once there's room for it in the pool.
+
+        Transient 5xx responses to idempotent requests are retried with
+        exponential backoff, like transport.Adapter does.
+        """
+        path = urllib.parse.urlsplit(url).path
+        attempt = 0
+        while True:
+            async with self.pool.limit:
+                with self.tracer.span('http', method=method, path=path) as event:
+                    request = self.client.build_request(method, url, **kwargs)
+                    response = await self.client.send(request, stream=stream)
+                    event['status'] = response.status_code
+                    if not stream:
+                        event['bytes'] = response.num_bytes_downloaded
+            if (
+                method != 'GET'
+                or response.status_code not in transport.RETRY_STATUSES
+                or attempt == transport.RETRIES
+            ):
+                return response
+            await response.aclose()
+            await asyncio.sleep(transport.RETRY_BACKOFF * 2**attempt)
+            attempt += 1
+
+    def _update(self, response):
+        if 'text/html' in response.headers.get('Content-Type', ''):
+            self.page = bs4.BeautifulSoup(response.content, aib.PAGE_PARSER)
+        else:
+            self.page = None
+        self.url = str(response.url)
+        self.form = None
+
+    async def open(self, url, headers=None):
+        """Requests url, and makes the response the current page."""
+        response = await self.request('GET', url, headers=headers)
+        self._update(response)
+        return response
+
+    def select_form(self, selector='form', nr=0):
+        """Selects a form on the current page, returns it."""
+        found = self.page.select(selector, limit=nr + 1)
+        if len(found) <= nr:
+            raise mechanicalsoup.LinkNotFoundError(
+                'No form matches %s (nr=%d)' % (selector, nr)
+            )
+        self.form = mechanicalsoup.Form(found[nr])
+        return self.form
+
+    def __setitem__(self, name, value):
+        self.form[name] = value
+
+    async def submit_unparsed(self, stream=False, timeout=None):
+        """Submits the selected form, leaving the current page as it is."""
+        self.form.choose_submit(None)
+        request = mechanicalsoup.Browser.get_request_kwargs(self.form.form, self.url)
+        headers = {'Referer': self.url}
+        kwargs = {'headers': headers}
+        if request.get('params'):
+            kwargs['params'] = request['params']
+        if request.get('data'):
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            kwargs['content'] = urllib.parse.urlencode(request['data'])
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        return await self.request(
+            request['method'].upper(), request['url'], stream=stream, **kwargs
+        )
+
+    async def submit_selected(self):
+        """Submits the selected form, and makes the response the current page."""
+        response = await self.submit_unparsed()
+        self._update(response)
+        return response
+
+    async def download(self, timeout=None):
+        """Submits the selected form, saving the response body to a file.
+
+        Returns the file, status of the response and its size in bytes.
+        """
+        response = await self.submit_unparsed(stream=True, timeout=timeout)
+        try:
+            csv_file = await _spool_async_lines(response.aiter_lines())
+        finally:
+            await response.aclose()
+        return csv_file, response.status_code, response.num_bytes_downloaded
+
+
+async def _spool_async_lines(lines):
+    """Saves lines of text to an anonymous temporary file, as they come."""
+    spool = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+    separator = ''
+    async for line in lines:
+        spool.write(separator)
+        spool.write(line)
+        separator = '\n'
+    spool.seek(0)
+    return spool
+
+
+class AsyncAib(aib.Site):
+    """Asynchronous counterpart of aib.Aib, sharing a Pool with others.
+
+    See aib.Site for the meaning of the arguments; requests go through
+    own_transport, if given, instead of the pool's connections. Sessions aren't
+    cached.
+    """
+
+    def __init__(
+        self,
+        logindata,
+        chatter,
+        pool,
+        tfa_timeout=None,
+        tracer=None,
+        account_filter=None,
+        unchanged=None,
+        since=None,
+        timeouts=None,
+        own_transport=None,
+    ):
+        super().__init__(
+            logindata, chatter, tfa_timeout, tracer, account_filter, unchanged, since
+        )
+        self.pool = pool
+        self.timeouts = timeouts
+        self.client = pool.client(own_transport)
+        self.client.timeout = pool.timeout('page', timeouts)
+        self.pages = AsyncBrowser(self.client, pool, self.tracer)
+
+    def _timeout(self, request_class):
+        return self.pool.timeout(request_class, self.timeouts)
+
+    async def _sleep(self, seconds):
+        # Other users get on with their requests meanwhile.
+        await asyncio.sleep(seconds)
+
+    async def login(self):
+        """Go through the login process."""
+        with self.tracer.span('login'):
+            await self._login()
+
+    async def get_data(self):
+        """Download data for all accounts."""
+        if not self.login_done:
+            await self.login()
+        with self.tracer.span('get_data'):
+            await self._get_data()
+
+    async def bye(self):
+        """Logs user out of bank's online interface."""
+        await self._logout()
+
+    async def aclose(self):
+        """Releases the client; the pool's connections stay open."""
+        await self.client.aclose()
@@ -0,0 +1,186 @@
+"""Local archive of transactions from all runs, in an SQLite database.
+
+Transactions are kept per account, deduplicated on their FITIDs, so the same
+transaction fetched by any number of runs is archived once. Dates are ISO
+strings, amounts are decimals as text, so nothing is lost on the way in.
+Exports are made from aib.Account objects rebuilt out of the archive: their
+FITIDs come out the same as when the transactions were first fetched, as
+they're computed from the same data, day by day.
+"""
+
+import datetime
+import decimal
+import os
+import sqlite3
+
+from aib2ofx import aib, ofx
+
+# Name of the archive file in the state directory.
+ARCHIVE_NAME = 'archive.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    account_id TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    type TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    bank_id TEXT NOT NULL,
+    balance TEXT,
+    available TEXT,
+    report_date TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS operations (
+    account_id TEXT NOT NULL,
+    fitid TEXT NOT NULL,
+    date TEXT NOT NULL,
+    description TEXT NOT NULL,
+    debit TEXT,
+    credit TEXT,
+    UNIQUE (account_id, fitid)
+);
+CREATE INDEX IF NOT EXISTS operations_by_date ON operations (account_id, date);
+"""
+
+# Summary of an account is only replaced by a more recent one.
+_UPSERT_ACCOUNT = """
+INSERT INTO accounts VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (account_id) DO UPDATE SET
+    user = excluded.user,
+    type = excluded.type,
+    currency = excluded.currency,
+    bank_id = excluded.bank_id,
+    balance = excluded.balance,
+    available = excluded.available,
+    report_date = excluded.report_date
+WHERE excluded.report_date >= accounts.report_date
+"""
+
+_INSERT_OPERATION = 'INSERT OR IGNORE INTO operations VALUES (?, ?, ?, ?, ?, ?)'
+
+# Operations come out in date order; those of the same day, in the order
+# they were archived in, which is the order of the bank's export.
+_SELECT_OPERATIONS = """
+SELECT date, description, debit, credit FROM operations
+WHERE account_id = ? AND date BETWEEN ? AND ?
+ORDER BY date, rowid
+"""
+
+
+def _decimal(text):
+    return None if text is None else decimal.Decimal(text)
+
+
+class _ArchivedOperations:
+    """Operations of an account between two dates, read on every iteration."""
+
+    def __init__(self, db, account_id, start, end):
+        self.db = db
+        self.account_id = account_id
+        self.start = start.isoformat() if start else '0001-01-01'
+        self.end = end.isoformat() if end else '9999-12-31'
+
+    def __iter__(self):
+        rows = self.db.execute(
+            _SELECT_OPERATIONS, (self.account_id, self.start, self.end)
+        )
+        for date, description, debit, credit in rows:
+            yield aib.Operation(
+                datetime.date.fromisoformat(date),
+                description,
+                _decimal(debit),
+                _decimal(credit),
+            )
+
+
+class Archive:
+    """Transactions of every account ever archived, in an SQLite database.
+
+    Every thread needs an Archive object of its own. Used as a context
+    manager, it's closed at the end of the block.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # The whole transaction history is in there; it's readable only by
+        # its owner, and so are SQLite's journal files, which take after it.
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        # Other runs may be writing to it at the same time, eg. serve.
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes the database."""
+        self.db.close()
+
+    def add(self, user, account):
+        """Archives aib.Account of given user, returns number of new transactions.
+
+        The account's summary (balance etc.) replaces the archived one, unless
+        that's more recent.
+        """
+        rows = (
+            (
+                account.account_id,
+                fitid,
+                operation.timestamp.isoformat(),
+                operation.description,
+                aib.amount_text(operation.debit),
+                aib.amount_text(operation.credit),
+            )
+            for operation, _, _, _, fitid, _ in ofx.Transactions(account)
+        )
+        with self.db:
+            self.db.execute(
+                _UPSERT_ACCOUNT,
+                (
+                    account.account_id,
+                    user,
+                    account.type,
+                    account.currency,
+                    account.bank_id,
+                    aib.amount_text(account.balance),
+                    aib.amount_text(account.available),
+                    account.report_date.isoformat(),
+                ),
+            )
+            before = self.db.total_changes
+            self.db.executemany(_INSERT_OPERATION, rows)
+            return self.db.total_changes - before
+
+    def account_ids(self):
+        """Returns IDs of all archived accounts."""
+        rows = self.db.execute('SELECT account_id FROM accounts ORDER BY account_id')
+        return [account_id for (account_id,) in rows]
+
+    def account(self, account_id, start=None, end=None):
+        """Returns archived aib.Account, with operations between given dates.
+
+        Both dates are included; either can be None, for no limit. Returns
+        None if there's no such account in the archive.
+        """
+        row = self.db.execute(
+            'SELECT type, currency, bank_id, balance, available, report_date '
+            'FROM accounts WHERE account_id = ?',
+            (account_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        account_type, currency, bank_id, balance, available, report_date = row
+        account = aib.Account(
+            account_id,
+            available=_decimal(available),
+            currency=currency,
+            bank_id=bank_id,
+            report_date=datetime.datetime.fromisoformat(report_date),
+        )
+        account.type = account_type
+        account.balance = _decimal(balance)
+        account.operations = _ArchivedOperations(self.db, account_id, start, end)
+        return account
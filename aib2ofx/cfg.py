@@ -1,32 +1,275 @@
-"""Configuration file handling for aib2ofx."""
+"""Configuration file handling for aib2ofx.
+
+The config file is a JSON object with an entry of settings per user; see
+README.md for all of them. It's validated as a whole when it's read, but
+credentials kept outside of it are only looked up once they're needed.
+Parsed files are cached until they change, so re-reading one is cheap.
+"""
 
 import json
 import os
 import re
+import shlex
+import stat
+import subprocess
+import threading
+
+from aib2ofx import writers
+
+_DEFAULT_PATH = '~/.aib2ofx.json'
+
+# Trailing commas are tolerated; strings are matched too, so that commas
+# inside them are left alone.
+_TRAILING_COMMA_RE = re.compile(r'"(?:[^"\\]|\\.)*"|,(?=\s*[\]}])')
+
+# Settings, by type.
+_SECRETS = ('regNumber', 'pin')
+_NUMBERS = ('tfaTimeout', 'syncInterval')
+_LISTS = ('include', 'exclude', 'includeTypes', 'excludeTypes', 'formats')
+# Same classes of requests as transport.TIMEOUTS.
+_TIMEOUTS = ('page', 'export', 'poll')
+# Seconds to wait for a secret command; it may be asking for a passphrase.
+_COMMAND_TIMEOUT = 120
+
+# Parsed config files by path, along with mtime and size they had.
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class ConfigError(ValueError):
+    """Config file can't be read, or has invalid settings in it."""
+
+
+def _strip_trailing_commas(text):
+    return _TRAILING_COMMA_RE.sub(
+        lambda match: '' if match.group() == ',' else match.group(), text
+    )
+
+
+def _command_args(command):
+    """Returns arguments of a secret command, or None if it isn't a valid one."""
+    if isinstance(command, str):
+        try:
+            return shlex.split(command)
+        except ValueError:
+            return None
+    if isinstance(command, list) and all(isinstance(arg, str) for arg in command):
+        return command
+    return None
+
+
+def _check_secret(user, key, value):
+    if isinstance(value, str):
+        return
+    if isinstance(value, dict):
+        sources = set(value) & {'env', 'file', 'command'}
+        extra = set(value) - {'env', 'file', 'command', 'key'}
+        if len(sources) == 1 and not extra and ('key' not in value or 'file' in value):
+            if 'command' in value and not _command_args(value['command']):
+                raise ConfigError(
+                    'command for %s of user %s should be a non-empty string, '
+                    'or list of strings' % (key, user)
+                )
+            return
+    raise ConfigError(
+        '%s of user %s should be a string, or an object with one of "env", '
+        '"file" (and optionally "key") or "command"' % (key, user)
+    )
+
+
+def _check_settings(user, settings):
+    if not isinstance(settings, dict):
+        raise ConfigError('settings of user %s should be an object' % user)
+    for key in _SECRETS:
+        if key not in settings:
+            raise ConfigError('user %s has no %s' % (user, key))
+    for key, value in settings.items():
+        if key in _SECRETS:
+            _check_secret(user, key, value)
+        elif key in _NUMBERS:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ConfigError('%s of user %s should be a number' % (key, user))
+            if value <= 0:
+                raise ConfigError('%s of user %s should be positive' % (key, user))
+        elif key in _LISTS:
+            if not isinstance(value, list) or not all(
+                isinstance(item, str) for item in value
+            ):
+                raise ConfigError(
+                    '%s of user %s should be a list of strings' % (key, user)
+                )
+            if key == 'formats':
+                unknown = sorted(set(value) - set(writers.names()))
+                if unknown:
+                    raise ConfigError(
+                        'unknown formats for user %s: %s' % (user, ', '.join(unknown))
+                    )
+        elif key == 'timeouts':
+            if not isinstance(value, dict) or not all(
+                name in _TIMEOUTS
+                and not isinstance(seconds, bool)
+                and isinstance(seconds, (int, float))
+                and seconds > 0
+                for name, seconds in value.items()
+            ):
+                raise ConfigError(
+                    'timeouts of user %s should map some of %s to seconds'
+                    % (user, ', '.join(_TIMEOUTS))
+                )
+        else:
+            raise ConfigError('unknown setting %s of user %s' % (key, user))
+
+
+def _read_secret_file(path, key):
+    path = os.path.expanduser(path)
+    try:
+        with open(path) as inf:
+            if stat.S_IMODE(os.fstat(inf.fileno()).st_mode) & 0o077:
+                raise ConfigError(
+                    'secrets file %s is accessible by others, chmod it to 0600' % path
+                )
+            text = inf.read()
+    except OSError as exception:
+        raise ConfigError(
+            "can't read secrets file %s: %s" % (path, exception.strerror)
+        ) from None
+    if key is None:
+        return text.strip()
+    for line in text.splitlines():
+        name, separator, value = line.partition('=')
+        if separator and name.strip() == key:
+            return value.strip()
+    raise ConfigError('no %s in secrets file %s' % (key, path))
+
+
+def _run_secret_command(command):
+    args = _command_args(command)
+    if not args:
+        raise ConfigError('secret command %r is empty or malformed' % (command,))
+    try:
+        result = subprocess.run(
+            args, stdout=subprocess.PIPE, text=True, timeout=_COMMAND_TIMEOUT
+        )
+    except OSError as exception:
+        raise ConfigError("can't run %s: %s" % (args[0], exception.strerror)) from None
+    except subprocess.TimeoutExpired:
+        raise ConfigError(
+            '%s gave no answer within %d seconds' % (args[0], _COMMAND_TIMEOUT)
+        ) from None
+    if result.returncode:
+        raise ConfigError('%s failed with status %d' % (args[0], result.returncode))
+    # Password managers print the secret on the first line, like pass does.
+    lines = result.stdout.splitlines()
+    return lines[0].strip() if lines else ''
+
+
+def _resolve_secret(value):
+    """Returns the secret that value is, or points at."""
+    if isinstance(value, str):
+        return value
+    if 'env' in value:
+        try:
+            return os.environ[value['env']]
+        except KeyError:
+            raise ConfigError(
+                'environment variable %s is not set' % value['env']
+            ) from None
+    if 'file' in value:
+        return _read_secret_file(value['file'], value.get('key'))
+    return _run_secret_command(value['command'])
+
+
+class User:
+    """Validated settings of a single user.
+
+    Settings are read with get(), by their names in the config file.
+    Credentials are looked up on the first call to credentials(), wherever
+    they're kept: in the config file itself, an environment variable, a
+    secrets file or the output of a command.
+    """
+
+    def __init__(self, name, settings):
+        _check_settings(name, settings)
+        self.name = name
+        self.settings = settings
+        self._credentials = None
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns a setting, or default if it's not set."""
+        return self.settings.get(key, default)
+
+    def credentials(self):
+        """Returns dict with regNumber and pin of the user, for aib.Aib."""
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = {
+                    key: _resolve_secret(self.settings[key]) for key in _SECRETS
+                }
+            return self._credentials
+
+
+def _parse(path):
+    try:
+        with open(path) as inf:
+            text = inf.read()
+    except OSError as exception:
+        raise ConfigError(
+            "can't read config file %s: %s" % (path, exception.strerror)
+        ) from None
+    try:
+        raw = json.loads(_strip_trailing_commas(text))
+    except ValueError as exception:
+        raise ConfigError('%s is not valid JSON: %s' % (path, exception)) from None
+    if not isinstance(raw, dict):
+        raise ConfigError('%s should hold an object, with an entry per user' % path)
+    return raw, {name: User(name, settings) for name, settings in raw.items()}
+
+
+def load(config_filename=_DEFAULT_PATH):
+    """Returns raw config and User objects by name, parsing the file if needed.
+
+    The file is parsed again only if its modification time or size differs
+    from the last time.
+    """
+    path = os.path.expanduser(config_filename)
+    try:
+        info = os.stat(path)
+    except OSError as exception:
+        raise ConfigError(
+            "can't read config file %s: %s" % (path, exception.strerror)
+        ) from None
+    version = (info.st_mtime_ns, info.st_size)
+    with _cache_lock:
+        cached = _cache.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+    parsed = _parse(path)
+    with _cache_lock:
+        _cache[path] = (version, parsed)
+    return parsed
 
 
 class Config:
-    """Simple dictionary-like config object."""
+    """Simple dictionary-like config object, of User objects by name.
 
-    def __init__(self, config_filename='~/.aib2ofx.json'):
-        filepath = open(os.path.expanduser(config_filename))
-        config_string = filepath.read(-1)
-        filepath.close()
+    Changes to the file are picked up as they happen, eg. by the serve command.
+    """
 
-        # Kill trailing commas.
-        trailing_commas = re.compile(r',\s*([\]}])')
-        config_string = trailing_commas.sub(r'\g<1>', config_string)
-        self.cfg = json.loads(config_string)
+    def __init__(self, config_filename=_DEFAULT_PATH):
+        self.path = config_filename
+        load(self.path)
 
     def get_config(self):
         """Returns the entire config object."""
-        return self.cfg
+        return load(self.path)[0]
 
     def users(self):
         """Returns list of configured users."""
-        return list(self.cfg.keys())
+        return list(load(self.path)[1])
 
     def __getitem__(self, name):
-        if name in self.cfg:
-            return self.cfg[name]
-        raise AttributeError
+        users = load(self.path)[1]
+        if name in users:
+            return users[name]
+        raise KeyError('no user %s in %s' % (name, self.path))
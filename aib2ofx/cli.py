@@ -1,15 +1,29 @@
-"""Command line interface of aib2ofx."""
+"""Command line interface of aib2ofx.
+
+Modules needed only for talking to the bank (and their dependencies, like
+mechanicalsoup or httpx) are imported where they're used, so that commands
+which never go online, and --help, start quickly; see
+benchmarks/bench_startup.py.
+"""
 
 import argparse
 import datetime
+import decimal
 import errno
+import json
 import os
 import re
+import shutil
 import sys
+import threading
+import time
+import urllib.parse
+
+from aib2ofx import cfg, files, state, writers
 
-import dateutil.parser as dparser
 
-from aib2ofx import aib, cfg, ofx
+def _default_output_dir():
+    return os.path.join('.', datetime.date.today().strftime('%Y-%m-%d'))
 
 
 def get_options():
@@ -17,12 +31,15 @@ def get_options():
     parser = argparse.ArgumentParser(
         description='Download data from aib.ie in OFX format'
     )
+    # Defaults of options that subcommands share, but with defaults of their
+    # own, are filled in once the subcommand is known.
     parser.add_argument(
         '-d',
         '--output-dir',
-        default=os.path.join('.', datetime.date.today().strftime('%Y-%m-%d')),
+        default=None,
         dest='output_dir',
-        help='directory to put OFX files in [%(default)s]',
+        help="directory to put OFX files in [today's date, eg. ./%s]"
+        % _default_output_dir(),
     )
     parser.add_argument(
         '-D',
@@ -54,77 +71,978 @@ def get_options():
         dest='preserve_csvs',
         help='Keep downloaded CSV files along produced OFX files',
     )
+    parser.add_argument(
+        '--compress-csvs',
+        choices=sorted(files.COMPRESSIONS),
+        default=None,
+        dest='compress_csvs',
+        help='compress CSV files kept with --preserve-csvs',
+    )
+    parser.add_argument(
+        '--fsync',
+        action='store_true',
+        default=False,
+        dest='fsync',
+        help='make sure output files are on the disk before moving on',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=None,
+        dest='jobs',
+        help='number of users to scrape concurrently, or of requests in '
+        'flight with --async [1]',
+    )
+    parser.add_argument(
+        '--async',
+        action='store_true',
+        default=False,
+        dest='use_async',
+        help='scrape all users at once on a single thread; needs httpx [%(default)s]',
+    )
+    parser.add_argument(
+        '-i',
+        '--incremental',
+        action='store_true',
+        default=False,
+        dest='incremental',
+        help='export only transactions not exported by previous runs',
+    )
+    parser.add_argument(
+        '--state-dir',
+        default='~/.aib2ofx-state',
+        dest='state_dir',
+        help='directory to keep incremental export state in [%(default)s]',
+    )
+    parser.add_argument(
+        '--archive',
+        action='store_true',
+        default=False,
+        dest='archive',
+        help='also keep fetched transactions in an archive in the state '
+        'directory, for the export command [%(default)s]',
+    )
+    parser.add_argument(
+        '--2fa-timeout',
+        type=int,
+        default=None,
+        dest='tfa_timeout',
+        help='seconds to wait for 2FA approval on the phone [tfaTimeout from '
+        'config, or 300]',
+    )
+    parser.add_argument(
+        '--timings',
+        default=None,
+        dest='timings',
+        metavar='FILE',
+        help='save timings of all phases and requests to a JSON file, and '
+        'print their summary',
+    )
+    parser.add_argument(
+        '--record',
+        default=None,
+        dest='record_dir',
+        metavar='DIR',
+        help='save scrubbed recordings of bank sessions, one per user, to DIR',
+    )
+    parser.add_argument(
+        '--replay',
+        default=None,
+        dest='replay_dir',
+        metavar='DIR',
+        help='replay sessions saved with --record instead of contacting the bank',
+    )
+    parser.add_argument(
+        '--session-cache',
+        action='store_true',
+        default=False,
+        dest='session_cache',
+        help='stay logged in between runs, reusing the session while it is '
+        'valid; sessions are kept encrypted in the state directory',
+    )
+    parser.add_argument(
+        '--format',
+        action='append',
+        choices=writers.names(),
+        default=None,
+        dest='formats',
+        help='output format, can be given several times to get several '
+        'formats out of one run [ofx]',
+    )
+    parser.add_argument(
+        '--consolidate',
+        choices=('user', 'run'),
+        default=None,
+        dest='consolidate',
+        help='put all accounts in a single OFX file per user (USER.ofx), or '
+        'per run (%s.ofx), instead of one file per account' % _RUN_NAME,
+    )
+    parser.add_argument(
+        '--include',
+        action='append',
+        default=None,
+        dest='include',
+        metavar='PATTERN',
+        help='fetch only accounts with IDs matching the pattern (eg. "*1234"); '
+        'can be repeated, overrides "include" from config',
+    )
+    parser.add_argument(
+        '--exclude',
+        action='append',
+        default=None,
+        dest='exclude',
+        metavar='PATTERN',
+        help='never fetch accounts with IDs matching the pattern; can be '
+        'repeated, overrides "exclude" from config',
+    )
+    parser.add_argument(
+        '--include-type',
+        action='append',
+        default=None,
+        dest='include_types',
+        metavar='TYPE',
+        help='fetch only accounts whose summary mentions TYPE (eg. "VISA"); '
+        'can be repeated, overrides "includeTypes" from config',
+    )
+    parser.add_argument(
+        '--exclude-type',
+        action='append',
+        default=None,
+        dest='exclude_types',
+        metavar='TYPE',
+        help='never fetch accounts whose summary mentions TYPE; can be '
+        'repeated, overrides "excludeTypes" from config',
+    )
+    parser.add_argument(
+        '--skip-unchanged',
+        action='store_true',
+        default=False,
+        dest='skip_unchanged',
+        help='skip exports of accounts whose balance and pending transactions '
+        'have not changed since the last run',
+    )
+
+    commands = parser.add_subparsers(dest='command', title='commands')
+    convert = commands.add_parser(
+        'convert',
+        help='turn CSV files saved with --preserve-csvs into OFX, without logging in',
+        description='Turn CSV files saved with --preserve-csvs into OFX files. '
+        'Account details are read from the NAME.account.json file saved next to '
+        'each CSV file. Without one, account ID is taken from the file name (the '
+        'part after the first "_"), and balances are left out.',
+    )
+    convert.add_argument(
+        'paths',
+        nargs='+',
+        metavar='PATH',
+        help='CSV file, or directory with CSV files',
+    )
+    # Options also accepted before the subcommand mustn't override the values
+    # given there with their defaults.
+    convert.add_argument(
+        '-d',
+        '--output-dir',
+        default=argparse.SUPPRESS,
+        dest='output_dir',
+        help='directory to put OFX files in [next to CSV files]',
+    )
+    convert.add_argument(
+        '-q',
+        '--quiet',
+        action='store_true',
+        default=argparse.SUPPRESS,
+        dest='quiet_mode',
+        help='display no output at all [False]',
+    )
+    convert.add_argument(
+        '-l',
+        '--later-than',
+        default=argparse.SUPPRESS,
+        dest='later_than',
+        help='exports only transactions later than specified date (YYYY-MM-DD)',
+    )
+    convert.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=argparse.SUPPRESS,
+        dest='jobs',
+        help='number of files to convert in parallel [%d]' % os.cpu_count(),
+    )
+    convert.add_argument(
+        '-f',
+        '--force',
+        action='store_true',
+        default=False,
+        dest='force',
+        help='convert even if the OFX file is newer than the CSV file',
+    )
+    convert.add_argument(
+        '--account-id',
+        default=None,
+        dest='account_id',
+        help='account ID to put in the OFX file, for a single CSV file '
+        '[from the account details]',
+    )
+    export_command = commands.add_parser(
+        'export',
+        help='write transactions kept with --archive, without logging in',
+        description='Write transactions of given accounts, kept in the archive '
+        'by runs with --archive, to a single file.',
+    )
+    export_command.add_argument(
+        '--state-dir',
+        default=argparse.SUPPRESS,
+        dest='state_dir',
+        help='directory the archive is kept in [~/.aib2ofx-state]',
+    )
+    export_command.add_argument(
+        '-a',
+        '--account',
+        action='append',
+        required=True,
+        dest='accounts',
+        metavar='ACCOUNT',
+        help='ID of the account to export; can be repeated',
+    )
+    export_command.add_argument(
+        '--from',
+        type=datetime.date.fromisoformat,
+        default=None,
+        dest='start',
+        metavar='YYYY-MM-DD',
+        help='export transactions from that day on',
+    )
+    export_command.add_argument(
+        '--to',
+        type=datetime.date.fromisoformat,
+        default=None,
+        dest='end',
+        metavar='YYYY-MM-DD',
+        help='export transactions up to that day, inclusive',
+    )
+    export_command.add_argument(
+        '-o',
+        '--output',
+        default='-',
+        dest='output',
+        help='file to write to, - for standard output [%(default)s]',
+    )
+    export_command.add_argument(
+        '--format',
+        choices=writers.names(),
+        default='ofx',
+        dest='format',
+        help='output format [%(default)s]',
+    )
+    serve_command = commands.add_parser(
+        'serve',
+        help='keep running, fetching data of every user periodically',
+        description='Keep running, fetching data of every user at its own '
+        'interval (syncInterval from config, in seconds). Users stay logged in '
+        'between syncs, for as long as the bank allows. Only accounts that '
+        'have changed are fetched and saved.',
+    )
+    serve_command.add_argument(
+        '--interval',
+        type=int,
+        default=3600,
+        dest='interval',
+        help='seconds between syncs of users without syncInterval [%(default)s]',
+    )
+    serve_command.add_argument(
+        '--status-port',
+        type=int,
+        default=8642,
+        dest='status_port',
+        help='serve status of syncs as JSON on this port of localhost, '
+        '0 to turn off [%(default)s]',
+    )
     return parser.parse_args()
 
 
-def write_file(output_dir, user, account_id, contents, extension):
-    """Save parsed data to a file."""
-    outf = open('%s/%s_%s.%s' % (output_dir, user, account_id, extension), 'w')
-    outf.write(contents)
-    outf.close()
+def output_path(output_dir, name, extension):
+    """Returns path of a file to save parsed data to."""
+    return os.path.join(output_dir, '%s.%s' % (name, extension))
+
 
+_print_lock = threading.Lock()
 
-def get_data(user, config, output_dir, later_than, chatter, preserve_csvs):
-    """Fetch, process and save data for a single user."""
+# Name of the file with accounts of all users, when they're consolidated.
+_RUN_NAME = 'aib2ofx'
+_DEFAULT_FORMATS = ['ofx']
+# Extension of files with account details, saved along with CSV exports.
+_ACCOUNT_EXTENSION = 'account.json'
+
+
+def get_data(user, config, options, chatter, tracer, sessions=None):
+    """Fetch, process and save data for a single user.
+
+    If a sessions dict is given, the user stays logged in, with the Aib object
+    kept there; next call picks it up, for as long as the session is valid.
+    """
+    from aib2ofx import replay
 
     def show_and_tell(pre, function, post='done.'):
         if chatter['quiet']:
             function()
+        elif chatter.get('prefix'):
+            # Several users are being scraped at once; print whole lines only,
+            # tagged with the user name, so that their progress doesn't mix.
+            with _print_lock:
+                print('[%s] %s' % (user, pre), flush=True)
+            function()
+            with _print_lock:
+                print('[%s] %s %s' % (user, pre, post), flush=True)
         else:
             print(pre, end=' ')
             sys.stdout.flush()
             function()
             print(post)
 
-    cleanup_re = re.compile('[- 	]+')
+    def tell(message):
+        if chatter['quiet']:
+            return
+        with _print_lock:
+            if chatter.get('prefix'):
+                message = '[%s] %s' % (user, message)
+            print(message, flush=True)
+
+    # Pick up the session left by the previous call, if it's still alive.
+    bank = sessions.get(user) if sessions is not None else None
+    if bank is not None and not bank.resume():
+        bank = None
+    cassette = '%s.json' % urllib.parse.quote(user, safe='')
+    if bank is None:
+        bank = make_bank(user, config[user], options, chatter, tracer)
+        if options.record_dir:
+            bank.mount(replay.RecordingAdapter(timeouts=config[user].get('timeouts')))
+        elif options.replay_dir:
+            bank.mount(
+                replay.ReplayAdapter.load(os.path.join(options.replay_dir, cassette))
+            )
+    if sessions is not None:
+        sessions[user] = bank
+    recorder = None
+    if isinstance(bank.adapter, replay.RecordingAdapter):
+        recorder = bank.adapter
+    try:
+        if not bank.login_done:
+            show_and_tell(
+                "Logging in as '%s' (check your phone for 2FA)..." % user, bank.login
+            )
+        show_and_tell('Scraping account pages for data...', bank.get_data)
+        # Logging out would make the kept or cached session useless.
+        if sessions is None and not options.session_cache:
+            show_and_tell("Logging '%s' out..." % user, bank.bye)
+    finally:
+        # Broken sessions are worth keeping too, for debugging.
+        if recorder:
+            os.makedirs(options.record_dir, exist_ok=True)
+            recorder.save(os.path.join(options.record_dir, cassette))
+    if bank.unchanged:
+        tell('Skipped %d unchanged account(s).' % len(bank.unchanged))
+
+    accounts = [(user, account) for account in bank.getdata().values() if account]
+    if options.consolidate != 'run':
+        save_accounts(
+            user, accounts, options, tracer.bind(user=user), config[user].get('formats')
+        )
+    return accounts
+
+
+def make_bank(user, creds, options, chatter, tracer):
+    """Returns aib.Aib set up for given user, according to options."""
+    from aib2ofx import aib
+
+    session_file = None
+    if options.session_cache:
+        session_file = os.path.join(
+            os.path.expanduser(options.state_dir),
+            'sessions',
+            urllib.parse.quote(user, safe='') + '.session',
+        )
+    return aib.Aib(
+        creds.credentials(),
+        chatter,
+        session_file,
+        **bank_options(user, creds, options, tracer),
+    )
+
+
+def bank_options(user, creds, options, tracer):
+    """Returns keyword arguments for aib.Aib or aio.AsyncAib of given user."""
+    from aib2ofx import aib
+
+    tracer = tracer.bind(user=user)
+
+    def setting(option, key):
+        # Command line wins over the config file.
+        value = getattr(options, option)
+        return creds.get(key, []) if value is None else value
+
+    account_filter = aib.AccountFilter(
+        setting('include', 'include'),
+        setting('exclude', 'exclude'),
+        setting('include_types', 'includeTypes'),
+        setting('exclude_types', 'excludeTypes'),
+    )
+    unchanged = None
+    if options.skip_unchanged:
+
+        def unchanged(account_id, fingerprint):
+            previous = state.AccountState(options.state_dir, user, account_id)
+            return previous.fingerprint == fingerprint
+
+    since = None
+    if options.later_than or options.incremental:
+        # Ask the bank only for the window that can end up in the output;
+        # transactions are still filtered exactly when writing OFX files.
+
+        def since(account_id):
+            dates = []
+            if options.later_than:
+                dates.append(options.later_than.date())
+            if options.incremental:
+                watermark = state.AccountState(
+                    options.state_dir, user, account_id
+                ).watermark
+                if watermark:
+                    dates.append(watermark)
+            return max(dates, default=None)
+
+    return {
+        'tfa_timeout': options.tfa_timeout or creds.get('tfaTimeout'),
+        'timeouts': creds.get('timeouts'),
+        'tracer': tracer,
+        'account_filter': account_filter,
+        'unchanged': unchanged,
+        'since': since,
+    }
+
+
+def save_accounts(name, accounts, options, tracer, formats=None):
+    """Save (user, aib.Account) pairs in requested formats, and CSV exports.
+
+    Every account gets its own file per format, unless they're to be
+    consolidated into a single one, called after name. Formats given on the
+    command line win over those passed here, eg. from the user's settings.
+    """
+    from aib2ofx import aib
+
+    cleanup_re = re.compile('[- \t]+')
+
+    def account_name(user, account):
+        return '%s_%s' % (user, re.sub(cleanup_re, '_', account.account_id).lower())
+
+    statements = []
+    for user, account in accounts:
+        account_state = None
+        if options.incremental or options.skip_unchanged:
+            account_state = state.AccountState(
+                options.state_dir, user, account.account_id
+            )
+        statements.append((user, account, account_state))
+
+    # Files to write, by name, with statements to put in them.
+    if options.consolidate:
+        outputs = [(name, statements)] if statements else []
+    else:
+        outputs = [
+            (account_name(user, account), [(user, account, account_state)])
+            for user, account, account_state in statements
+        ]
+    formats = options.formats or formats or _DEFAULT_FORMATS
+    for output_format in map(writers.get, formats):
+        for output_name, output_statements in outputs:
+            path = output_path(options.output_dir, output_name, output_format.extension)
+            with tracer.span(output_format.name) as event:
+                with files.atomic_write(
+                    path, output_format.binary, fsync=options.fsync
+                ) as outf:
+                    event['rows'] = output_format.write(
+                        [
+                            (account, account_state if options.incremental else None)
+                            for _, account, account_state in output_statements
+                        ],
+                        outf,
+                        options.later_than,
+                    )
+
+    if options.archive:
+        from aib2ofx import archive
+
+        state_dir = os.path.expanduser(options.state_dir)
+        os.makedirs(state_dir, mode=0o700, exist_ok=True)
+        with tracer.span('archive') as event:
+            with archive.Archive(os.path.join(state_dir, archive.ARCHIVE_NAME)) as db:
+                event['rows'] = sum(
+                    db.add(user, account) for user, account, _ in statements
+                )
+
+    for user, account, account_state in statements:
+        # Only remember transactions once they're safely in the output files.
+        if account_state is not None:
+            if options.skip_unchanged:
+                account_state.fingerprint = account.fingerprint
+            account_state.commit()
+        # save CSVs too, if requested
+        if options.preserve_csvs:
+            account.csv.seek(0)
+            extension = 'csv' + files.COMPRESSIONS.get(options.compress_csvs, '')
+            path = output_path(
+                options.output_dir, account_name(user, account), extension
+            )
+            with files.atomic_write(
+                path, compression=options.compress_csvs, fsync=options.fsync
+            ) as outf:
+                shutil.copyfileobj(account.csv, outf)
+            # The file name is mangled, and the export has no balance of
+            # credit card accounts; convert needs both.
+            path = output_path(
+                options.output_dir, account_name(user, account), _ACCOUNT_EXTENSION
+            )
+            with files.atomic_write(path, fsync=options.fsync) as outf:
+                json.dump(
+                    {
+                        'accountId': account.account_id,
+                        'available': aib.amount_text(account.available),
+                        'currency': account.currency,
+                        'bankId': account.bank_id,
+                        'reportDate': account.report_date.isoformat(),
+                    },
+                    outf,
+                )
 
-    # Login to the bank, get data for all accounts.
-    creds = config[user]
-    bank = aib.Aib(creds, chatter)
-    show_and_tell("Logging in as '%s' (check your phone for 2FA)..." % user, bank.login)
-    show_and_tell('Scraping account pages for data...', bank.get_data)
-    show_and_tell("Logging '%s' out..." % user, bank.bye)
 
-    # Save each account to separate OFX file.
-    for account in bank.getdata().values():
+def fetch_concurrently(config, options, chatter, tracer):
+    """Run get_data for all users on a pool of worker threads."""
+    import concurrent.futures
+
+    # Every user gets its own Aib object and thus its own StatefulBrowser, so
+    # threads don't share any scraping state. A failure of one user is
+    # reported, but doesn't stop the others.
+    chatter = dict(chatter, prefix=True)
+
+    def say(message):
+        if not chatter['quiet']:
+            with _print_lock:
+                print(message, flush=True)
+
+    def fetch(user):
+        start = time.monotonic()
+        try:
+            accounts = get_data(user, config, options, chatter, tracer)
+        except Exception as exception:
+            if chatter['debug']:
+                import traceback
+
+                with _print_lock:
+                    traceback.print_exc()
+            say('[%s] failed: %s' % (user, exception))
+            return None
+        say('[%s] finished in %.1fs.' % (user, time.monotonic() - start))
+        return accounts
+
+    start = time.monotonic()
+    users = config.users()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as pool:
+        results = dict(zip(users, pool.map(fetch, users)))
+    say('All users processed in %.1fs.' % (time.monotonic() - start))
+    _finish_run(results, options, tracer)
+
+
+def fetch_async(config, options, chatter, tracer):
+    """Run all users at once on an event loop, with aio.AsyncAib objects.
+
+    They share a pool of connections, with at most options.jobs requests in
+    flight. Like with fetch_concurrently, a failed user doesn't stop others.
+    """
+    import asyncio
+
+    from aib2ofx import aio, replay
+
+    chatter = dict(chatter, prefix=True)
+
+    def say(message):
+        if not chatter['quiet']:
+            print(message, flush=True)
+
+    async def fetch(pool, user):
+        start = time.monotonic()
+        bank = None
+        try:
+            own_transport = None
+            if options.replay_dir:
+                cassette = '%s.json' % urllib.parse.quote(user, safe='')
+                own_transport = aio.ReplayTransport(
+                    replay.ReplayAdapter.load(
+                        os.path.join(options.replay_dir, cassette)
+                    )
+                )
+            # Credentials are looked up here, and that can fail too.
+            bank = aio.AsyncAib(
+                config[user].credentials(),
+                chatter,
+                pool,
+                own_transport=own_transport,
+                **bank_options(user, config[user], options, tracer),
+            )
+            say('[%s] Logging in (check your phone for 2FA)...' % user)
+            await bank.login()
+            say('[%s] Scraping account pages for data...' % user)
+            await bank.get_data()
+            await bank.bye()
+            accounts = [
+                (user, account) for account in bank.getdata().values() if account
+            ]
+            if options.consolidate != 'run':
+                # Writing files in the loop would hold up other users.
+                await asyncio.to_thread(
+                    save_accounts,
+                    user,
+                    accounts,
+                    options,
+                    tracer.bind(user=user),
+                    config[user].get('formats'),
+                )
+        except Exception as exception:
+            if chatter['debug']:
+                import traceback
+
+                traceback.print_exc()
+            say('[%s] failed: %s' % (user, exception))
+            return None
+        finally:
+            if bank is not None:
+                await bank.aclose()
+        if bank.unchanged:
+            say('[%s] Skipped %d unchanged account(s).' % (user, len(bank.unchanged)))
+        say('[%s] finished in %.1fs.' % (user, time.monotonic() - start))
+        return accounts
+
+    async def fetch_all(users):
+        pool = aio.Pool(options.jobs)
+        try:
+            return await asyncio.gather(*(fetch(pool, user) for user in users))
+        finally:
+            await pool.aclose()
+
+    start = time.monotonic()
+    users = config.users()
+    results = dict(zip(users, asyncio.run(fetch_all(users))))
+    say('All users processed in %.1fs.' % (time.monotonic() - start))
+    _finish_run(results, options, tracer)
+
+
+def _finish_run(results, options, tracer):
+    # results are lists of (user, account) pairs by user, None for failures.
+    failed = [user for user, accounts in results.items() if accounts is None]
+    if options.consolidate == 'run':
+        # Whatever was fetched is worth saving, even if some users failed.
+        accounts = [pair for pairs in results.values() if pairs for pair in pairs]
+        save_accounts(_RUN_NAME, accounts, options, tracer)
+    if failed:
+        sys.exit('Failed to fetch data for: %s' % ', '.join(failed))
+
+
+_CSV_SUFFIXES = ('.csv',) + tuple('.csv' + c for c in files.COMPRESSIONS.values())
+
+
+def _csv_stem(csv_path):
+    """Returns CSV file name without its extension(s)."""
+    name = os.path.basename(csv_path)
+    for suffix in _CSV_SUFFIXES:
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return os.path.splitext(name)[0]
+
+
+def _account_details(csv_path):
+    """Returns account details saved next to a CSV export, or {} if there are none."""
+    path = os.path.join(
+        os.path.dirname(csv_path), '%s.%s' % (_csv_stem(csv_path), _ACCOUNT_EXTENSION)
+    )
+    try:
+        with open(path) as inf:
+            return json.load(inf)
+    except FileNotFoundError:
+        return {}
+
+
+def convert_file(csv_path, ofx_path, later_than, account_id=None):
+    """Turn a single CSV export into OFX file."""
+    from aib2ofx import aib, ofx
+
+    details = _account_details(csv_path)
+    if not account_id:
+        # Files saved before account details were: the ID is lowercased, with
+        # spaces and dashes replaced, in there.
+        account_id = details.get('accountId') or _csv_stem(csv_path).split('_', 1)[-1]
+    if 'reportDate' in details:
+        report_date = datetime.datetime.fromisoformat(details['reportDate'])
+    else:
+        report_date = datetime.datetime.fromtimestamp(os.path.getmtime(csv_path))
+    available = details.get('available')
+    with files.open_text(csv_path, newline='') as csv_file:
+        account = aib._csv2account(
+            csv_file,
+            aib.Account(
+                account_id,
+                available=None if available is None else decimal.Decimal(available),
+                currency=details.get('currency', 'EUR'),
+                bank_id=details.get('bankId', 'AIB'),
+                report_date=report_date,
+            ),
+        )
         if not account:
+            raise ValueError('%s is empty' % csv_path)
+        # A file left as it was would look out of date next time.
+        with files.atomic_write(ofx_path, dedupe=False) as outf:
+            ofx.write_ofx(account, outf, later_than)
+
+
+def convert(options):
+    """Convert CSV exports to OFX files on a pool of worker processes."""
+    import concurrent.futures
+
+    csv_paths = []
+    for path in options.paths:
+        if os.path.isdir(path):
+            # Outputs of the csv format live next to the exports, but aren't any.
+            outputs = tuple(
+                '.' + writers.get(name).extension for name in writers.names()
+            )
+            csv_paths.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.endswith(_CSV_SUFFIXES) and not name.endswith(outputs)
+            )
+        else:
+            csv_paths.append(path)
+
+    if options.account_id and len(csv_paths) != 1:
+        sys.exit('--account-id needs a single CSV file to convert.')
+    if options.output_dir:
+        os.makedirs(options.output_dir, exist_ok=True)
+    jobs = {}
+    for csv_path in csv_paths:
+        output_dir = options.output_dir or os.path.dirname(csv_path)
+        ofx_name = _csv_stem(csv_path) + '.ofx'
+        ofx_path = os.path.join(output_dir, ofx_name)
+        if (
+            not options.force
+            and os.path.exists(ofx_path)
+            and os.path.getmtime(ofx_path) >= os.path.getmtime(csv_path)
+        ):
             continue
-        name = re.sub(cleanup_re, '_', account['accountId']).lower()
-        contents = ofx.bankdata_to_ofx(account, later_than)
-        write_file(output_dir, user, name, contents, 'ofx')
-        # save CSVs too, if requested
-        if preserve_csvs:
-            contents = '\n'.join(account['csv'])
-            write_file(output_dir, user, name, contents, 'csv')
+        jobs[csv_path] = ofx_path
+
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs) as pool:
+        futures = {
+            pool.submit(
+                convert_file,
+                csv_path,
+                ofx_path,
+                options.later_than,
+                options.account_id,
+            ): csv_path
+            for csv_path, ofx_path in jobs.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            csv_path = futures[future]
+            try:
+                future.result()
+            except Exception as exception:
+                print('%s: failed: %s' % (csv_path, exception), file=sys.stderr)
+                failed.append(csv_path)
+            else:
+                if not options.quiet_mode:
+                    print('%s -> %s' % (csv_path, jobs[csv_path]))
+
+    if not options.quiet_mode:
+        print(
+            '%d converted, %d up to date, %d failed.'
+            % (len(jobs) - len(failed), len(csv_paths) - len(jobs), len(failed))
+        )
+    if failed:
+        sys.exit(1)
+
+
+def export(options):
+    """Write archived transactions of some accounts to a file."""
+    from aib2ofx import archive
+
+    path = os.path.join(os.path.expanduser(options.state_dir), archive.ARCHIVE_NAME)
+    if not os.path.exists(path):
+        sys.exit(
+            'No archive in %s, fetch data with --archive first.' % options.state_dir
+        )
+    output_format = writers.get(options.format)
+    try:
+        output_format.check_available()
+    except RuntimeError as exception:
+        sys.exit(str(exception))
+
+    with archive.Archive(path) as db:
+        accounts = []
+        for account_id in options.accounts:
+            account = db.account(account_id, options.start, options.end)
+            if account is None:
+                sys.exit(
+                    'No account %s in the archive; archived accounts: %s'
+                    % (account_id, ', '.join(db.account_ids()))
+                )
+            accounts.append((account, None))
+        if options.output == '-':
+            outf = sys.stdout.buffer if output_format.binary else sys.stdout
+            output_format.write(accounts, outf)
+            outf.flush()
+            return
+        with files.atomic_write(options.output, output_format.binary) as outf:
+            output_format.write(accounts, outf)
+
+
+def run_server(config, options, chatter, tracer):
+    """Sync users periodically until interrupted."""
+    from aib2ofx import serve
+
+    if options.consolidate == 'run':
+        sys.exit('--consolidate run makes no sense for serve, use user instead')
+    # Only changed accounts are worth writing out again.
+    options.skip_unchanged = True
+    chatter = dict(chatter, prefix=True)
+    sessions = {}
+
+    def sync(user):
+        # Timings are kept for the last sync of every user only.
+        tracer.discard(user=user)
+        sync_options = options
+        if options.output_dir is None:
+            sync_options = argparse.Namespace(**vars(options))
+            sync_options.output_dir = _default_output_dir()
+            os.makedirs(sync_options.output_dir, exist_ok=True)
+        get_data(user, config, sync_options, chatter, tracer, sessions)
+
+    scheduler = serve.Scheduler(
+        {
+            user: config[user].get('syncInterval', options.interval)
+            for user in config.users()
+        },
+        sync,
+        scrub=tracer.scrub,
+        debug=chatter['debug'],
+    )
+    server = None
+    if options.status_port:
+        server = serve.serve_status(scheduler, options.status_port)
+    try:
+        scheduler.run()
+    finally:
+        if server:
+            server.shutdown()
 
 
 def main():
     """Main script entry point."""
     # Parse command line options.
     options = get_options()
+    if options.later_than:
+        import dateutil.parser as dparser
+
+        options.later_than = dparser.parse(
+            options.later_than, dayfirst=False, yearfirst=True
+        )
+    if options.command == 'convert':
+        options.jobs = options.jobs or os.cpu_count()
+        convert(options)
+        return
+    if options.command == 'export':
+        export(options)
+        return
+
+    options.jobs = options.jobs or 1
+    # serve, which runs for days, picks the directory on every sync instead.
+    if options.output_dir is None and options.command != 'serve':
+        options.output_dir = _default_output_dir()
+
+    # Read user-provided credentials.
+    try:
+        config = cfg.Config()
+    except cfg.ConfigError as exception:
+        sys.exit(str(exception))
+
+    formats = set(options.formats or _DEFAULT_FORMATS)
+    if not options.formats:
+        for user in config.users():
+            formats.update(config[user].get('formats', ()))
+    try:
+        for name in sorted(formats):
+            writers.get(name).check_available()
+        files.check_available(options.compress_csvs)
+    except RuntimeError as exception:
+        sys.exit(str(exception))
+
     chatter = {
         'quiet': options.quiet_mode,
         'debug': options.debug_mode,
     }
-    if options.later_than:
-        later_than = dparser.parse(options.later_than, dayfirst=False, yearfirst=True)
-    else:
-        later_than = None
+    if options.session_cache:
+        from aib2ofx import session
 
-    # Read user-provided credentials.
-    config = cfg.Config()
+        try:
+            session.check_available()
+        except RuntimeError as exception:
+            sys.exit(str(exception))
+    if options.use_async:
+        if options.command == 'serve':
+            sys.exit('--async is not supported by serve')
+        if options.session_cache or options.record_dir:
+            sys.exit('--async works without --session-cache and --record')
+        from aib2ofx import aio
 
-    try:
-        os.makedirs(options.output_dir)
-    except OSError as exception:
-        if exception.errno != errno.EEXIST:
-            raise
+        try:
+            aio.check_available()
+        except RuntimeError as exception:
+            sys.exit(str(exception))
+
+    if options.output_dir:
+        try:
+            os.makedirs(options.output_dir)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+    from aib2ofx import aib, trace
 
     # Iterate through accounts, scrape, format and save data.
-    for user in config.users():
-        get_data(
-            user, config, options.output_dir, later_than, chatter, options.preserve_csvs
-        )
+    tracer = trace.Tracer(
+        scrub=aib.CleansingFormatter().scrub, record=bool(options.timings)
+    )
+    try:
+        if options.command == 'serve':
+            run_server(config, options, chatter, tracer)
+        elif options.use_async:
+            fetch_async(config, options, chatter, tracer)
+        elif options.jobs > 1:
+            fetch_concurrently(config, options, chatter, tracer)
+        else:
+            results = {}
+            for user in config.users():
+                try:
+                    results[user] = get_data(user, config, options, chatter, tracer)
+                except cfg.ConfigError as exception:
+                    # Credentials are looked up only now; others may be fine.
+                    print('%s: %s' % (user, exception), file=sys.stderr)
+                    results[user] = None
+            _finish_run(results, options, tracer)
+    finally:
+        if options.timings:
+            tracer.write_json(options.timings)
+            if not chatter['quiet']:
+                print(tracer.summary())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+"""Safe writing of output files, and (de)compression of archived exports."""
+
+import contextlib
+import filecmp
+import gzip
+import importlib.util
+import io
+import os
+import shutil
+import tempfile
+
+# File name suffixes of supported compression methods.
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+_BUFFER_SIZE = 1 << 16
+_SPOOL_SIZE = 1 << 20
+
+# Files are created with the usual permissions; umask can only be read by
+# setting it, which is best done once, before any threads are started.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def check_available(compression):
+    """Raises RuntimeError if given compression method can't be used."""
+    # zstandard itself is only imported when it's needed.
+    if compression == 'zstd' and importlib.util.find_spec('zstandard') is None:
+        raise RuntimeError(
+            'zstd compression needs the "zstandard" package, '
+            'install aib2ofx[zstd] to get it'
+        )
+
+
+def _compressed(raw, compression):
+    if compression == 'gzip':
+        # No timestamp in the header, so that same content compresses the same.
+        return gzip.GzipFile(fileobj=raw, mode='wb', mtime=0)
+    if compression == 'zstd':
+        check_available(compression)
+        import zstandard
+
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    return None
+
+
+@contextlib.contextmanager
+def atomic_write(path, binary=False, compression=None, fsync=False, dedupe=True):
+    """Yields a file object that replaces path once the block succeeds.
+
+    The data goes to a temporary file next to path first, so that readers
+    never see a partial file, and a failure leaves the old file intact. With
+    fsync, the data is on the disk before path is replaced. With dedupe, a
+    file with the same content as the existing one isn't replaced at all, so
+    its modification time doesn't change. Text files are written with the
+    locale's encoding, like open() does.
+    """
+    directory, name = os.path.split(path)
+    directory = directory or '.'
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % name, suffix='.tmp', dir=directory)
+    try:
+        os.fchmod(fd, 0o666 & ~_UMASK)
+        with open(fd, 'wb', buffering=_BUFFER_SIZE) as raw:
+            compressor = _compressed(raw, compression)
+            outf = compressor or raw
+            if not binary:
+                outf = io.TextIOWrapper(outf)
+            yield outf
+            if not binary:
+                outf.detach()
+            if compressor:
+                compressor.close()
+            if fsync:
+                raw.flush()
+                os.fsync(raw.fileno())
+        if dedupe and os.path.exists(path) and filecmp.cmp(tmp_path, path, False):
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def open_text(path, **kwargs):
+    """Opens text file for reading, decompressing it if its name says so."""
+    if path.endswith(COMPRESSIONS['gzip']):
+        return gzip.open(path, 'rt', **kwargs)
+    if path.endswith(COMPRESSIONS['zstd']):
+        check_available('zstd')
+        import zstandard
+
+        # Parsing needs a seekable file, which zstd streams aren't.
+        spool = tempfile.SpooledTemporaryFile(_SPOOL_SIZE, 'w+', **kwargs)
+        with zstandard.open(path, 'rb') as inf:
+            shutil.copyfileobj(io.TextIOWrapper(inf, **kwargs), spool)
+        spool.seek(0)
+        return spool
+    return open(path, **kwargs)
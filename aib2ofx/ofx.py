@@ -1,7 +1,16 @@
 """Functionality related to producing OFX format out of parsed data."""
 
+import datetime
+import io
+import shutil
+import tempfile
 from hashlib import sha256
-from xml.sax.saxutils import escape
+
+
+def _escape(text):
+    # Same as xml.sax.saxutils.escape(), which is slow to import: it pulls in
+    # urllib.request, and the whole HTTP client with it.
+    return text.replace('&', '&amp;').replace('>', '&gt;').replace('<', '&lt;')
 
 
 _OPENING = """OFXHEADER:100
@@ -26,10 +35,17 @@ NEWFILEUID:NONE
 </SIGNONMSGSRSV1>"""
 
 
+# Statements of the same kind are grouped in a message set; a document can
+# have one of each.
+_MESSAGE_SETS = {
+    'checking': ('\n<BANKMSGSRSV1>', '</BANKMSGSRSV1>'),
+    'credit': ('\n<CREDITCARDMSGSRSV1>', '</CREDITCARDMSGSRSV1>'),
+}
+
+
 _HEADERS = {
     'checking': """
-<BANKMSGSRSV1>
-<STMTTRNRS><TRNUID>1</TRNUID>
+<STMTTRNRS><TRNUID>%(trnuid)d</TRNUID>
 <STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>
 <STMTRS><CURDEF>%(currency)s</CURDEF>
 <BANKACCTFROM><BANKID>%(bankId)s</BANKID>
@@ -37,8 +53,7 @@ _HEADERS = {
 <ACCTTYPE>CHECKING</ACCTTYPE>
 </BANKACCTFROM>""",
     'credit': """
-<CREDITCARDMSGSRSV1>
-<CCSTMTTRNRS><TRNUID>1</TRNUID>
+<CCSTMTTRNRS><TRNUID>%(trnuid)d</TRNUID>
 <STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>
 <CCSTMTRS><CURDEF>%(currency)s</CURDEF>
 <CCACCTFROM>
@@ -47,97 +62,264 @@ _HEADERS = {
 }
 
 
-_TRANSACTIONS = """
+_TRANSACTIONS_START = """
 <BANKTRANLIST>
 <DTSTART>%(firstDate)s</DTSTART>
 <DTEND>%(lastDate)s</DTEND>
-%(transactions)s
+"""
+
+
+_TRANSACTIONS_END = """
 </BANKTRANLIST>"""
 
 
+# Balances of a statement, by the key of the amount in them. Those whose
+# amount isn't known (None) are left out.
+_BALANCES = {
+    'checking': (
+        (
+            'balance',
+            '\n<LEDGERBAL><BALAMT>%(balance)s</BALAMT>'
+            '<DTASOF>%(reportDate)s</DTASOF></LEDGERBAL>',
+        ),
+        (
+            'available',
+            '\n<AVAILBAL><BALAMT>%(available)s</BALAMT>'
+            '<DTASOF>%(reportDate)s</DTASOF></AVAILBAL>',
+        ),
+    ),
+    'credit': (
+        (
+            'available',
+            '\n<LEDGERBAL><BALAMT>%(available)s</BALAMT>'
+            '<DTASOF>%(reportDate)s</DTASOF></LEDGERBAL>',
+        ),
+    ),
+}
+
+
 _CLOSING = {
     'checking': """
-<LEDGERBAL><BALAMT>%(balance)s</BALAMT><DTASOF>%(reportDate)s</DTASOF></LEDGERBAL>
-<AVAILBAL><BALAMT>%(available)s</BALAMT><DTASOF>%(reportDate)s</DTASOF></AVAILBAL>
-</STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>""",
+</STMTRS></STMTTRNRS>""",
     'credit': """
-<LEDGERBAL><BALAMT>%(available)s</BALAMT><DTASOF>%(reportDate)s</DTASOF></LEDGERBAL>
-</CCSTMTRS></CCSTMTTRNRS></CREDITCARDMSGSRSV1></OFX>""",
+</CCSTMTRS></CCSTMTTRNRS>""",
 }
 
 
+_END = '</OFX>'
+
+
+# Filled in positionally: type, timestamp, amount, FITID, description.
 _SINGLE_TRANSACTION = """<STMTTRN>
-<TRNTYPE>%(type)s</TRNTYPE>
-<DTPOSTED>%(timestamp)s</DTPOSTED>
-<TRNAMT>%(amount)s</TRNAMT>
-<FITID>%(tid)s</FITID>
-<NAME>%(description)s</NAME>
+<TRNTYPE>%s</TRNTYPE>
+<DTPOSTED>%s</DTPOSTED>
+<TRNAMT>%s</TRNAMT>
+<FITID>%s</FITID>
+<NAME>%s</NAME>
 </STMTTRN>
 """
 
+# Transactions are written out in batches of that many.
+_BATCH = 1024
+
 
 def _to_date(date):
     return date.strftime('%Y%m%d%H%M%S')
 
 
-def bankdata_to_ofx(bank_data, later_than=None):
-    """Turns dictionary into OFX document."""
-    ofx = ''
-    data = {}
-
-    # Move obvious things to data.
-    data = bank_data.copy()
-
-    # Calculate rest of necessary fields.
-    data['reportDate'] = _to_date(data['reportDate'])
-    if data['operations']:
-        data['firstDate'] = _to_date(data['operations'][0]['timestamp'])
-        data['lastDate'] = _to_date(data['operations'][-1]['timestamp'])
-    else:
-        data['firstDate'] = data['reportDate']
-        data['lastDate'] = data['reportDate']
-
-    # Turn set of transactions into a lengthy string.
-    hashes = {}
-    transactions = []
-    for transaction in data['operations']:
-        trx = transaction.copy()
-        if later_than and trx['timestamp'] <= later_than:
-            continue
-        trx['description'] = escape(trx['description'])
-        if trx['credit'] and float(trx['credit']) != 0:
-            trx['type'] = 'CREDIT'
-            trx['amount'] = trx['credit']
-        else:
-            trx['type'] = 'DEBIT'
-            trx['amount'] = '-%s' % trx['debit']
-        trx['timestamp'] = _to_date(trx['timestamp'])
-        hsh = sha256(
-            trx['timestamp'].encode("utf-8")
-            + trx['amount'].encode("utf-8")
-            + trx['description'].encode("utf-8")
-        )
-        digest = hsh.hexdigest()
-        # If there's been a transaction with identical hash in the current
-        # set, record this and modify the hash to be different in OFX.
-        if digest in hashes:
-            count = hashes[digest] + 1
-            hashes[digest] = count
-            hsh.update(b'%d' % count)
+def _write_batch(outf, batch, emitted):
+    # Transactions are separated by empty lines.
+    if emitted:
+        outf.write('\n')
+    outf.write('\n'.join(batch))
+    return emitted + len(batch)
+
+
+def write_document(statements, outf, later_than=None):
+    """Writes OFX document with statements of several accounts to a file.
+
+    Statements are (aib.Account, state.AccountState or None) pairs, see
+    write_statement(). All checking accounts end up in a single message set,
+    followed by all credit card ones; there's one signon block, with the
+    report date of the first account. Returns the number of transactions
+    written.
+    """
+    statements = list(statements)
+    if not statements:
+        return 0
+    outf.write(_OPENING % {'reportDate': _to_date(statements[0][0].report_date)})
+    outf.write('\n')
+    emitted = 0
+    for account_type, (start, end) in _MESSAGE_SETS.items():
+        trnuid = 0
+        for account, state in statements:
+            if account.type != account_type:
+                continue
+            if not trnuid:
+                outf.write(start)
+            trnuid += 1
+            emitted += write_statement(account, outf, later_than, state, trnuid)
+        if trnuid:
+            outf.write(end)
+    outf.write(_END)
+    return emitted
+
+
+def write_ofx(account, outf, later_than=None, state=None):
+    """Writes OFX document for given aib.Account to a file-like object.
+
+    See write_statement() for the meaning of the arguments. Returns the number
+    of transactions written.
+    """
+    return write_document([(account, state)], outf, later_than)
+
+
+class Transactions:
+    """Transactions of an aib.Account that are due for export, with FITIDs.
+
+    Yields (operation, trntype, timestamp, amount, fitid, description) tuples,
+    all but the first formatted as in OFX; the description is escaped.
+    Operations are consumed one at a time, so they can come from a generator.
+    Those up to later_than are left out. If a state.AccountState is passed,
+    transactions recorded there are left out too, and the ones yielded are
+    added to it. Once iterated over, first and last hold timestamps of the
+    first and last operation, whether they were left out or not.
+
+    Operations have to come in date order, or at least with all those of a
+    day next to each other, as exports are; ValueError is raised otherwise.
+    """
+
+    def __init__(self, account, later_than=None, state=None):
+        if isinstance(later_than, datetime.datetime):
+            later_than = later_than.date()
+        self.account = account
+        self.later_than = later_than
+        self.state = state
+        self.first = self.last = None
+
+    def __iter__(self):
+        later_than = self.later_than
+        state = self.state
+        watermark = state.watermark if state is not None else None
+        first = last = None
+        # Hashed text starts with the timestamp, so identical hashes can only
+        # come from the same day. Exports are in date order, with all the
+        # transactions of a day next to each other; counts of hashes (and the
+        # formatted timestamp) are kept for the current day only, so memory
+        # use doesn't grow with the number of transactions. A day coming back
+        # would need the counts already dropped, for its duplicates to get
+        # the same FITIDs as always; that's an error, not a silent collision.
+        day = stamp = None
+        hashes = {}
+        days = set()
+        for operation in self.account.operations:
+            timestamp = operation.timestamp
+            if first is None:
+                first = self.first = timestamp
+            last = timestamp
+            if later_than and timestamp <= later_than:
+                continue
+            # Days before the watermark have been exported in full already.
+            # The watermark day itself is checked transaction by transaction.
+            if watermark and timestamp < watermark:
+                continue
+            description = operation.description
+            if '&' in description or '<' in description or '>' in description:
+                description = _escape(description)
+            # Decimal zero is falsy, same as a missing amount.
+            if operation.credit:
+                trntype = 'CREDIT'
+                amount = str(operation.credit)
+            else:
+                trntype = 'DEBIT'
+                # Formatted exactly as it always was, as it feeds into FITID.
+                debit = operation.debit
+                amount = '-' if debit is None else '-%s' % debit
+            if timestamp != day:
+                if timestamp in days:
+                    raise ValueError(
+                        'transactions of %s on %s are not next to each other, '
+                        "can't give them stable IDs"
+                        % (self.account.account_id, timestamp)
+                    )
+                days.add(timestamp)
+                day = timestamp
+                stamp = _to_date(timestamp)
+                hashes.clear()
+            hsh = sha256((stamp + amount + description).encode('utf-8'))
+            digest = hsh.digest()
+            # If there's been a transaction with identical hash in the current
+            # set, record this and modify the hash to be different in OFX.
+            count = hashes.get(digest)
+            if count is None:
+                hashes[digest] = 1
+            else:
+                count += 1
+                hashes[digest] = count
+                hsh.update(b'%d' % count)
+            tid = hsh.hexdigest()
+            if state is not None:
+                if tid in state:
+                    continue
+                state.add(tid, timestamp)
+            yield operation, trntype, stamp, amount, tid, description
+        self.last = last
+
+
+def write_statement(account, outf, later_than=None, state=None, trnuid=1):
+    """Writes statement of given aib.Account, without the document around it.
+
+    See Transactions for the meaning of the arguments. Returns the number of
+    transactions written.
+    """
+    data = {
+        'accountId': account.account_id,
+        'available': account.available,
+        'balance': account.balance,
+        'bankId': account.bank_id,
+        'currency': account.currency,
+        'reportDate': _to_date(account.report_date),
+        'trnuid': trnuid,
+    }
+
+    # Transactions go to a spool first, as the header needs the date range.
+    # The spool only hits the disk for long transaction lists.
+    with tempfile.SpooledTemporaryFile(
+        max_size=1 << 20, mode='w+', encoding='utf-8', newline=''
+    ) as spool:
+        transactions = Transactions(account, later_than, state)
+        emitted = 0
+        batch = []
+        for _, trntype, stamp, amount, tid, description in transactions:
+            batch.append(
+                _SINGLE_TRANSACTION % (trntype, stamp, amount, tid, description)
+            )
+            if len(batch) == _BATCH:
+                emitted = _write_batch(spool, batch, emitted)
+                batch = []
+        if batch:
+            emitted = _write_batch(spool, batch, emitted)
+
+        if transactions.first is None:
+            data['firstDate'] = data['reportDate']
+            data['lastDate'] = data['reportDate']
         else:
-            hashes[digest] = 1
-        trx['tid'] = hsh.hexdigest()
-        transactions.append(_SINGLE_TRANSACTION % trx)
-    data['transactions'] = '\n'.join(transactions)
+            data['firstDate'] = _to_date(transactions.first)
+            data['lastDate'] = _to_date(transactions.last)
 
-    # Wrap up and return resulting OFX.
-    ofx = '\n'.join(
-        (
-            _OPENING,
-            _HEADERS[data['type']],
-            _TRANSACTIONS,
-            _CLOSING[data['type']],
-        )
-    )
-    ofx = ofx % data
-    return ofx
+        outf.write('\n'.join((_HEADERS[account.type], _TRANSACTIONS_START)) % data)
+        spool.seek(0)
+        shutil.copyfileobj(spool, outf)
+        outf.write(_TRANSACTIONS_END + '\n')
+        for key, balance in _BALANCES[account.type]:
+            if data[key] is not None:
+                outf.write(balance % data)
+        outf.write(_CLOSING[account.type])
+    return emitted
+
+
+def bankdata_to_ofx(account, later_than=None, state=None):
+    """Turns aib.Account into OFX document."""
+    ofx = io.StringIO()
+    write_ofx(account, ofx, later_than, state)
+    return ofx.getvalue()
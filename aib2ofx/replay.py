@@ -0,0 +1,163 @@
+"""Recording of online banking sessions, and their offline replay.
+
+A recording ("cassette") is a JSON file with an ordered list of HTTP
+interactions. It's scrubbed while being recorded: credentials are dropped from
+requests, amounts and descriptions are replaced in responses (dates too, outside
+CSV exports), in a way that keeps pages and CSV exports parseable. Replay serves interactions in the
+recorded order, so the flow in aib.Aib has to stay the same for a cassette to
+remain usable. Cassettes can be replayed by aio.AsyncAib too, through
+aio.ReplayTransport.
+"""
+
+import csv
+import io
+import json
+import re
+import urllib.parse
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from aib2ofx import aib, transport
+
+# Response headers worth keeping; cookies and the like are of no use on replay.
+_KEPT_HEADERS = ('Content-Type', 'Location')
+
+# Form fields never to be recorded.
+_SECRET_FIELDS = ('pf.username', 'pf.pass')
+
+# Pages are scrubbed like debug logs, except that amounts have to stay
+# parseable.
+_PAGE_SCRUBBER = aib.CleansingFormatter(
+    rules=[
+        (pattern, '1.00' if replacement == 'X.XX' else replacement)
+        for pattern, replacement in aib.SCRUB_RULES
+    ],
+    starts=aib.SCRUB_STARTS,
+)
+
+# CSV exports keep their dates, which are needed to parse them.
+_AMOUNT_RE = re.compile(r'(?:\d+,)*\d+\.\d\d\b')
+
+
+def _scrub_csv(text):
+    rows = list(csv.reader(io.StringIO(text), skipinitialspace=True))
+    if not rows:
+        return text
+    descriptions = [
+        number for number, name in enumerate(rows[0]) if name.startswith('Description')
+    ]
+    for row in rows[1:]:
+        for number in descriptions:
+            if number < len(row) and row[number]:
+                row[number] = 'dummy description'
+    out = io.StringIO()
+    csv.writer(out, quoting=csv.QUOTE_ALL, lineterminator='\n').writerows(rows[1:])
+    # Header goes back as it was; its exact form matters for parsing.
+    return text.splitlines()[0] + '\n' + _AMOUNT_RE.sub('1.00', out.getvalue())
+
+
+def scrub_response(content_type, text):
+    """Returns response body with amounts, dates and descriptions replaced."""
+    if 'csv' in content_type or text.startswith(('Posted Account', 'Masked Card')):
+        return _scrub_csv(text)
+    return _PAGE_SCRUBBER.scrub(text)
+
+
+def scrub_request(body):
+    """Returns form-encoded request body without credentials."""
+    fields = urllib.parse.parse_qsl(body, keep_blank_values=True)
+    return urllib.parse.urlencode(
+        [(name, 'X' if name in _SECRET_FIELDS else value) for name, value in fields]
+    )
+
+
+class RecordingAdapter(transport.Adapter):
+    """Transport adapter saving every interaction it makes, scrubbed."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interactions = []
+
+    def send(self, request, *args, **kwargs):
+        response = super().send(request, *args, **kwargs)
+        body = request.body or ''
+        if isinstance(body, bytes):
+            body = body.decode('latin1')
+        content_type = response.headers.get('Content-Type', '')
+        # Bodies are kept as latin1 text, which maps bytes 1:1 to characters.
+        text = scrub_response(content_type, response.content.decode('latin1'))
+        self.interactions.append(
+            {
+                'method': request.method,
+                'path': urllib.parse.urlsplit(request.url).path,
+                'request': scrub_request(body),
+                'status': response.status_code,
+                'reason': response.reason,
+                'headers': {
+                    name: response.headers[name]
+                    for name in _KEPT_HEADERS
+                    if name in response.headers
+                },
+                'body': text,
+            }
+        )
+        return response
+
+    def save(self, path):
+        """Writes recorded interactions to a cassette file."""
+        with open(path, 'w') as outf:
+            json.dump({'interactions': self.interactions}, outf, indent=1)
+
+
+class ReplayError(AssertionError):
+    """Raised when requests made diverge from the recorded ones."""
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport adapter answering requests from a cassette, in order."""
+
+    def __init__(self, interactions):
+        super().__init__()
+        self.interactions = list(interactions)
+        self.position = 0
+
+    @classmethod
+    def load(cls, path):
+        """Creates adapter replaying a cassette file."""
+        with open(path) as inf:
+            return cls(json.load(inf)['interactions'])
+
+    def next_interaction(self, method, url):
+        """Returns the interaction recorded for a request, checking it matches."""
+        if self.position >= len(self.interactions):
+            raise ReplayError('no more recorded interactions for %s' % url)
+        interaction = self.interactions[self.position]
+        self.position += 1
+        path = urllib.parse.urlsplit(url).path
+        if (method, path) != (interaction['method'], interaction['path']):
+            raise ReplayError(
+                'expected %s %s, got %s %s'
+                % (interaction['method'], interaction['path'], method, path)
+            )
+        return interaction
+
+    def send(self, request, *args, **kwargs):
+        interaction = self.next_interaction(request.method, request.url)
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.reason = interaction.get('reason', '')
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        body = interaction['body']
+        response.raw = io.BytesIO(
+            body.encode('latin1') if isinstance(body, str) else body
+        )
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,115 @@
+"""Long running mode: periodic syncs of every user, with a status endpoint."""
+
+import datetime
+import http.server
+import json
+import threading
+import time
+import traceback
+
+
+class Scheduler:
+    """Runs sync(user) for every user, each at its own interval.
+
+    Every user gets a thread of its own, so that one waiting for 2FA doesn't
+    hold the others back. Next sync is due interval seconds after the start
+    of the previous one, or right away if that took longer. Failures are
+    recorded in the status, passed through scrub, and retried at the next
+    interval.
+    """
+
+    def __init__(self, intervals, sync, scrub=None, debug=False):
+        self.intervals = intervals
+        self.sync = sync
+        self.scrub = scrub or (lambda text: text)
+        self.debug = debug
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._status = {
+            user: {
+                'interval': interval,
+                'syncs': 0,
+                'last_sync': None,
+                'duration': None,
+                'error': None,
+                'next_sync': None,
+            }
+            for user, interval in intervals.items()
+        }
+
+    def status(self):
+        """Returns a JSON-able dict with state of syncs, by user."""
+        with self._lock:
+            return {user: dict(status) for user, status in self._status.items()}
+
+    def _run_user(self, user):
+        interval = self.intervals[user]
+        while not self.stopping.is_set():
+            started = datetime.datetime.now().isoformat(timespec='seconds')
+            start = time.monotonic()
+            error = None
+            try:
+                self.sync(user)
+            except Exception as exception:
+                if self.debug:
+                    traceback.print_exc()
+                error = self.scrub('%s: %s' % (type(exception).__name__, exception))
+            duration = time.monotonic() - start
+            wait = max(interval - duration, 0)
+            next_sync = datetime.datetime.now() + datetime.timedelta(seconds=wait)
+            with self._lock:
+                status = self._status[user]
+                status['syncs'] += 1
+                status['last_sync'] = started
+                status['duration'] = round(duration, 1)
+                status['error'] = error
+                status['next_sync'] = next_sync.isoformat(timespec='seconds')
+            self.stopping.wait(wait)
+
+    def run(self):
+        """Syncs users until stop() is called, or the process is interrupted."""
+        threads = [
+            threading.Thread(target=self._run_user, args=(user,), daemon=True)
+            for user in self.intervals
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                self.stopping.wait(1)
+        except KeyboardInterrupt:
+            # Syncs in progress are left to be killed along with the process.
+            self.stop()
+
+    def stop(self):
+        """Asks all users' threads to finish after their current sync."""
+        self.stopping.set()
+
+
+class _StatusHandler(http.server.BaseHTTPRequestHandler):
+    scheduler = None
+
+    def do_GET(self):
+        body = json.dumps(self.scheduler.status(), indent=2).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Nobody's watching the stderr of a daemon.
+        pass
+
+
+def serve_status(scheduler, port, host='127.0.0.1'):
+    """Serves the scheduler's status as JSON over HTTP, in a background thread.
+
+    Only listens on the loopback interface by default; the status has no
+    amounts in it, but user names and errors are nobody else's business.
+    Returns the server, to be shut down with its shutdown() method.
+    """
+    handler = type('StatusHandler', (_StatusHandler,), {'scheduler': scheduler})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,67 @@
+"""Encrypted on-disk cache of authenticated browser sessions."""
+
+import base64
+import hashlib
+import json
+import os
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+_SALT_SIZE = 16
+_KDF_ROUNDS = 200000
+
+
+def check_available():
+    """Raises RuntimeError if the session cache can't be used."""
+    if Fernet is None:
+        raise RuntimeError(
+            'session cache needs the "cryptography" package, '
+            'install aib2ofx[session-cache] to get it'
+        )
+
+
+def _cipher(secret, salt):
+    check_available()
+    key = hashlib.pbkdf2_hmac('sha256', secret.encode('utf-8'), salt, _KDF_ROUNDS)
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def save(path, secret, data):
+    """Encrypts JSON-able data with a key derived from secret, saves it to path.
+
+    The file is only ever readable by its owner.
+    """
+    salt = os.urandom(_SALT_SIZE)
+    token = _cipher(secret, salt).encrypt(json.dumps(data).encode('utf-8'))
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as outf:
+        outf.write(salt + token)
+    os.replace(tmp_path, path)
+
+
+def load(path, secret):
+    """Returns data saved with save(), or None if there's nothing usable."""
+    try:
+        with open(path, 'rb') as inf:
+            blob = inf.read()
+    except FileNotFoundError:
+        return None
+    try:
+        plaintext = _cipher(secret, blob[:_SALT_SIZE]).decrypt(blob[_SALT_SIZE:])
+    except InvalidToken:
+        # Corrupted, or encrypted with different credentials.
+        return None
+    return json.loads(plaintext)
+
+
+def forget(path):
+    """Removes saved session, if there's one."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
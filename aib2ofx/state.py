@@ -0,0 +1,106 @@
+"""Persistent record of already exported transactions, for incremental runs."""
+
+import datetime
+import json
+import os
+import urllib.parse
+
+# FITIDs are hex encoded sha256 digests; they're stored in their raw form.
+_FITID_SIZE = 32
+
+
+class AccountState:
+    """Sync state of a single account: export watermark, emitted FITIDs etc.
+
+    FITIDs live in an append-only file of raw digests, 32 bytes per
+    transaction, and are loaded into a set for quick lookups on first use.
+    Everything else (eg. the watermark) is kept in a small JSON file next to it.
+    """
+
+    def __init__(self, state_dir, user, account_id):
+        self.state_dir = os.path.expanduser(state_dir)
+        name = '%s_%s' % (
+            urllib.parse.quote(user, safe=''),
+            urllib.parse.quote(account_id, safe=''),
+        )
+        self.path = os.path.join(self.state_dir, name)
+        self.info = {}
+        self._fitids = None
+        # Kept in a dict, as an ordered set.
+        self._new_fitids = {}
+        self._new_watermark = None
+        try:
+            with open(self.path + '.json') as inf:
+                self.info = json.load(inf)
+        except FileNotFoundError:
+            pass
+
+    @property
+    def fitids(self):
+        """Set of raw FITIDs exported so far."""
+        if self._fitids is None:
+            self._fitids = self._load_fitids()
+        return self._fitids
+
+    def _load_fitids(self):
+        try:
+            with open(self.path + '.fitids', 'rb') as inf:
+                blob = inf.read()
+        except FileNotFoundError:
+            return set()
+        # An interrupted append can leave a partial record at the end. Drop it,
+        # so that further appends stay aligned.
+        end = len(blob) - len(blob) % _FITID_SIZE
+        if end != len(blob):
+            os.truncate(self.path + '.fitids', end)
+        return {blob[pos : pos + _FITID_SIZE] for pos in range(0, end, _FITID_SIZE)}
+
+    @property
+    def watermark(self):
+        """Date of the latest exported transaction."""
+        if not self.info.get('watermark'):
+            return None
+        return datetime.date.fromisoformat(self.info['watermark'])
+
+    @property
+    def fingerprint(self):
+        """Fingerprint of the account summary seen by the last export."""
+        return self.info.get('fingerprint')
+
+    @fingerprint.setter
+    def fingerprint(self, value):
+        self.info['fingerprint'] = value
+
+    def __contains__(self, fitid):
+        # Only committed transactions count, so that the same export can be
+        # written out in several formats before committing.
+        return bytes.fromhex(fitid) in self.fitids
+
+    def add(self, fitid, timestamp):
+        """Records a transaction as exported; it's saved on commit()."""
+        self._new_fitids[bytes.fromhex(fitid)] = None
+        if self._new_watermark is None or timestamp > self._new_watermark:
+            self._new_watermark = timestamp
+
+    def commit(self):
+        """Saves transactions recorded since the last commit."""
+        os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+        if self._new_fitids:
+            with open(self.path + '.fitids', 'ab') as outf:
+                outf.write(b''.join(self._new_fitids))
+            self.fitids.update(self._new_fitids)
+            self._new_fitids = {}
+        if self._new_watermark is not None:
+            watermark = self._new_watermark.isoformat()
+            if watermark > self.info.get('watermark', ''):
+                self.info['watermark'] = watermark
+            self._new_watermark = None
+        self.save_info()
+
+    def save_info(self):
+        """Atomically rewrites the JSON part of the state."""
+        os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+        tmp_path = self.path + '.json.tmp'
+        with open(tmp_path, 'w') as outf:
+            json.dump(self.info, outf)
+        os.replace(tmp_path, self.path + '.json')
@@ -0,0 +1,120 @@
+"""Timing instrumentation of scraping runs."""
+
+import contextlib
+import json
+import threading
+import time
+import urllib.parse
+
+import requests
+
+
+class Tracer:
+    """Collects timings of scraping phases and HTTP requests.
+
+    Every event is a dict with a 'name', 'start' (seconds since the tracer was
+    created), 'duration' and any extra attributes, eg. HTTP status or row
+    count. Tracers made with bind() add their context to every event, and
+    share events with their parent. Reports are passed through scrub, so that
+    nothing sensitive ends up in them. Without record, events are timed but
+    not kept, so that long running processes don't pile them up.
+    """
+
+    def __init__(self, scrub=None, record=True, **context):
+        self.scrub = scrub
+        self.record = record
+        self.context = context
+        self.events = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def bind(self, **context):
+        """Returns a tracer adding given attributes to all its events."""
+        child = Tracer(self.scrub, self.record, **dict(self.context, **context))
+        child.events = self.events
+        child.origin = self.origin
+        child._lock = self._lock
+        return child
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """Times the enclosed block; yields event dict to add attributes to."""
+        event = dict(self.context, name=name, **attrs)
+        start = time.perf_counter()
+        try:
+            yield event
+        except BaseException as exception:
+            event['error'] = type(exception).__name__
+            raise
+        finally:
+            event['start'] = start - self.origin
+            event['duration'] = time.perf_counter() - start
+            if self.record:
+                with self._lock:
+                    self.events.append(event)
+
+    def discard(self, **context):
+        """Forgets events with given attributes, eg. those of a previous sync."""
+        with self._lock:
+            self.events[:] = [
+                event
+                for event in self.events
+                if any(event.get(key) != value for key, value in context.items())
+            ]
+
+    def report(self):
+        """Returns scrubbed events, in order of their start."""
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event['start'])
+        if not self.scrub:
+            return events
+        return [
+            {
+                key: self.scrub(value) if isinstance(value, str) else value
+                for key, value in event.items()
+            }
+            for event in events
+        ]
+
+    def write_json(self, path):
+        """Saves report to a JSON file."""
+        with open(path, 'w') as outf:
+            json.dump({'events': self.report()}, outf, indent=2)
+            outf.write('\n')
+
+    def summary(self):
+        """Returns human readable totals per phase, longest first."""
+        totals = {}
+        for event in self.report():
+            count, total, longest = totals.get(event['name'], (0, 0, 0))
+            duration = event['duration']
+            totals[event['name']] = (
+                count + 1,
+                total + duration,
+                max(longest, duration),
+            )
+        lines = ['%-24s %6s %9s %9s' % ('phase', 'count', 'total', 'max')]
+        for name, (count, total, longest) in sorted(
+            totals.items(), key=lambda item: -item[1][1]
+        ):
+            lines.append('%-24s %6d %8.2fs %8.2fs' % (name, count, total, longest))
+        return '\n'.join(lines)
+
+
+class TracedSession(requests.Session):
+    """Requests session recording every request it makes with a tracer."""
+
+    def __init__(self, tracer):
+        super().__init__()
+        self.tracer = tracer
+
+    def request(self, method, url, *args, **kwargs):
+        # Query strings can carry tokens; they're of no use for timings anyway.
+        path = urllib.parse.urlsplit(url).path
+        with self.tracer.span('http', method=method, path=path) as event:
+            response = super().request(method, url, *args, **kwargs)
+            event['status'] = response.status_code
+            # Streamed responses are measured by whoever reads them.
+            if not kwargs.get('stream'):
+                event['bytes'] = len(response.content)
+        return response
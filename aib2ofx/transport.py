@@ -0,0 +1,63 @@
+"""HTTP transport tuned for scraping a single bank site."""
+
+import urllib3
+from requests.adapters import HTTPAdapter
+
+# Read timeouts per class of request, in seconds. Exports take a while to be
+# generated; 2FA polls are answered right away, so a slow one is better
+# abandoned and retried by the polling loop.
+TIMEOUTS = {'page': 30, 'export': 120, 'poll': 10}
+CONNECT_TIMEOUT = 10
+
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Brotli is only advertised when urllib3 is able to decode it, ie. when the
+# brotli package is installed (aib2ofx[speedups]).
+ACCEPT_ENCODING = urllib3.util.make_headers(accept_encoding=True)['accept-encoding']
+
+
+class Adapter(HTTPAdapter):
+    """Keep-alive connection pool with retries and default timeouts.
+
+    Every user is scraped sequentially over a handful of hosts, so one
+    connection per host is enough; it's kept alive between requests. Failed
+    connections are retried for any request, as nothing was sent yet.
+    Transient 5xx responses are retried with exponential backoff, but only
+    for idempotent methods: resubmitting a form could do something twice.
+    Requests made without a timeout get the page one.
+    """
+
+    def __init__(self, retries=RETRIES, timeouts=None):
+        self.timeouts = dict(TIMEOUTS, **(timeouts or {}))
+        super().__init__(
+            pool_connections=4,
+            pool_maxsize=1,
+            max_retries=urllib3.Retry(
+                total=retries,
+                connect=retries,
+                read=retries,
+                status=retries,
+                backoff_factor=RETRY_BACKOFF,
+                status_forcelist=RETRY_STATUSES,
+                raise_on_status=False,
+            ),
+        )
+
+    def timeout(self, request_class):
+        """Returns (connect, read) timeout for a class of requests."""
+        return (CONNECT_TIMEOUT, self.timeouts[request_class])
+
+    def send(self, request, stream=False, timeout=None, *args, **kwargs):
+        if timeout is None:
+            timeout = self.timeout('page')
+        return super().send(request, stream, timeout, *args, **kwargs)
+
+    def stats(self):
+        """Returns numbers of requests made and connections opened so far."""
+        pools = [self.poolmanager.pools[key] for key in self.poolmanager.pools.keys()]
+        return {
+            'requests': sum(pool.num_requests for pool in pools),
+            'connections': sum(pool.num_connections for pool in pools),
+        }
@@ -0,0 +1,199 @@
+"""Output formats, all written from the same parsed aib.Account objects.
+
+Every writer takes a list of (aib.Account, state.AccountState or None) pairs,
+a file object and optional later_than date, and returns the number of
+transactions written; see ofx.Transactions for how these are picked. All
+formats share FITIDs with OFX, so transactions can be matched across them.
+"""
+
+import csv
+import decimal
+import importlib.util
+import json
+
+from aib2ofx import ofx
+
+_FORMATS = {}
+
+# Parquet rows are written in row groups of that size.
+_ROW_GROUP = 65536
+
+_COLUMNS = (
+    'account_id',
+    'account_type',
+    'date',
+    'amount',
+    'currency',
+    'type',
+    'description',
+    'fitid',
+)
+
+
+class Format:
+    """Output format: its writer, file extension and file mode."""
+
+    def __init__(self, name, write, extension, binary=False, check=None):
+        self.name = name
+        self.write = write
+        self.extension = extension
+        self.binary = binary
+        self.check = check
+
+    def check_available(self):
+        """Raises RuntimeError if the format can't be used."""
+        if self.check:
+            self.check()
+
+
+def register(name, extension, binary=False, check=None):
+    """Decorator adding a writer to the registry, under given format name."""
+
+    def decorator(write):
+        _FORMATS[name] = Format(name, write, extension, binary, check)
+        return write
+
+    return decorator
+
+
+def get(name):
+    """Returns Format registered under given name."""
+    try:
+        return _FORMATS[name]
+    except KeyError:
+        raise ValueError('unknown output format: %s' % name) from None
+
+
+def names():
+    """Returns names of all registered formats."""
+    return sorted(_FORMATS)
+
+
+def _amount(operation):
+    # Signed, as in a bank statement: money coming in is positive.
+    if operation.credit:
+        return operation.credit
+    return -(operation.debit or decimal.Decimal(0))
+
+
+def _rows(statements, later_than):
+    """Yields a tuple of _COLUMNS for every transaction due for export."""
+    for account, state in statements:
+        transactions = ofx.Transactions(account, later_than, state)
+        for operation, trntype, _, _, fitid, _ in transactions:
+            yield (
+                account.account_id,
+                account.type,
+                operation.timestamp,
+                _amount(operation),
+                account.currency,
+                trntype,
+                operation.description,
+                fitid,
+            )
+
+
+register('ofx', 'ofx')(ofx.write_document)
+
+
+@register('qif', 'qif')
+def write_qif(statements, outf, later_than=None):
+    """Writes transactions in QIF, dates as DD/MM/YYYY."""
+    emitted = 0
+    for account, state in statements:
+        qif_type = 'Bank' if account.type == 'checking' else 'CCard'
+        # Account headers are only needed to tell several accounts apart.
+        if len(statements) > 1:
+            outf.write('!Account\nN%s\nT%s\n^\n' % (account.account_id, qif_type))
+        outf.write('!Type:%s\n' % qif_type)
+        for operation, _, _, _, _, _ in ofx.Transactions(account, later_than, state):
+            outf.write(
+                'D%s\nT%s\nP%s\n^\n'
+                % (
+                    operation.timestamp.strftime('%d/%m/%Y'),
+                    _amount(operation),
+                    operation.description,
+                )
+            )
+            emitted += 1
+    return emitted
+
+
+@register('csv', 'transactions.csv')
+def write_csv(statements, outf, later_than=None):
+    """Writes transactions as CSV with a header row, one transaction per row.
+
+    Dates are in ISO format, amounts are signed.
+    """
+    writer = csv.writer(outf, lineterminator='\n')
+    writer.writerow(_COLUMNS)
+    emitted = 0
+    for row in _rows(statements, later_than):
+        writer.writerow(row)
+        emitted += 1
+    return emitted
+
+
+@register('jsonl', 'jsonl')
+def write_jsonl(statements, outf, later_than=None):
+    """Writes transactions as JSON Lines, one object per transaction.
+
+    Dates are in ISO format; amounts are signed strings, to keep them exact.
+    """
+    emitted = 0
+    for row in _rows(statements, later_than):
+        record = dict(zip(_COLUMNS, row))
+        record['date'] = record['date'].isoformat()
+        record['amount'] = str(record['amount'])
+        outf.write(json.dumps(record))
+        outf.write('\n')
+        emitted += 1
+    return emitted
+
+
+def _check_parquet():
+    # pyarrow takes a while to import, so it's only done when writing.
+    if importlib.util.find_spec('pyarrow') is None:
+        raise RuntimeError(
+            'parquet output needs the "pyarrow" package, '
+            'install aib2ofx[parquet] to get it'
+        )
+
+
+@register('parquet', 'parquet', binary=True, check=_check_parquet)
+def write_parquet(statements, outf, later_than=None):
+    """Writes transactions as a Parquet table, in row groups.
+
+    Amounts are decimals with two digits after the point.
+    """
+    _check_parquet()
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema(
+        [
+            ('account_id', pyarrow.string()),
+            ('account_type', pyarrow.string()),
+            ('date', pyarrow.date32()),
+            ('amount', pyarrow.decimal128(18, 2)),
+            ('currency', pyarrow.string()),
+            ('type', pyarrow.string()),
+            ('description', pyarrow.string()),
+            ('fitid', pyarrow.string()),
+        ]
+    )
+    cents = decimal.Decimal('0.01')
+    emitted = 0
+    with pyarrow.parquet.ParquetWriter(outf, schema) as writer:
+        columns = [[] for _ in _COLUMNS]
+        for row in _rows(statements, later_than):
+            for column, value in zip(columns, row):
+                column.append(value)
+            columns[3][-1] = columns[3][-1].quantize(cents)
+            emitted += 1
+            if len(columns[0]) == _ROW_GROUP:
+                writer.write_table(pyarrow.table(columns, schema=schema))
+                columns = [[] for _ in _COLUMNS]
+        if columns[0] or not emitted:
+            writer.write_table(pyarrow.table(columns, schema=schema))
+    return emitted
@@ -0,0 +1,68 @@
+"""Compares CSV date parsing speed: dateutil on every row vs aib._to_date.
+
+Run from the repository root:
+
+    python benchmarks/bench_dates.py [ROWS]
+"""
+
+import csv
+import sys
+import time
+
+import dateutil.parser as dparser
+import synthetic
+
+from aib2ofx import aib
+
+
+def _dateutil_to_date(text):
+    # The parser used before the fast path was introduced.
+    return dparser.parse(text, dayfirst=True, yearfirst=False)
+
+
+def _measure(label, rows, function):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print('%-32s %10.0f rows/s' % (label, rows / elapsed))
+    return elapsed
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lines = list(synthetic.checking_lines(rows))
+    dates = [
+        row['Posted Transactions Date']
+        for row in csv.DictReader(lines, skipinitialspace=True)
+    ]
+    csv_file = aib._spool_lines(lines)
+    account = aib._csv2account(csv_file, aib.Account('benchmark'))
+
+    print('%d rows, %d distinct dates' % (rows, len(set(dates))))
+
+    def parse_dates(to_date):
+        for text in dates:
+            to_date(text)
+
+    def parse_operations():
+        for _ in account.operations:
+            pass
+
+    before = _measure('dates, dateutil', rows, lambda: parse_dates(_dateutil_to_date))
+    aib._to_date.cache_clear()
+    after = _measure('dates, fast path', rows, lambda: parse_dates(aib._to_date))
+    print('%-32s %10.1fx' % ('speedup', before / after))
+
+    fast_to_date = aib._to_date
+    aib._to_date = _dateutil_to_date
+    try:
+        before = _measure('operations, dateutil', rows, parse_operations)
+    finally:
+        aib._to_date = fast_to_date
+    aib._to_date.cache_clear()
+    after = _measure('operations, fast path', rows, parse_operations)
+    print('%-32s %10.1fx' % ('speedup', before / after))
+
+
+if __name__ == '__main__':
+    main()
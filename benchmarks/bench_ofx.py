@@ -0,0 +1,127 @@
+"""Compares OFX serializer speed: the previous, template based one vs ofx.
+
+Both write the same synthetic statement, which has to come out identical.
+Operations are parsed upfront, so that only serialization is measured.
+Run from the repository root:
+
+    python benchmarks/bench_ofx.py [ROWS]
+"""
+
+import io
+import sys
+import time
+from hashlib import sha256
+from xml.sax.saxutils import escape
+
+import synthetic
+
+from aib2ofx import aib, ofx
+
+_SINGLE_TRANSACTION = """<STMTTRN>
+<TRNTYPE>%(type)s</TRNTYPE>
+<DTPOSTED>%(timestamp)s</DTPOSTED>
+<TRNAMT>%(amount)s</TRNAMT>
+<FITID>%(tid)s</FITID>
+<NAME>%(description)s</NAME>
+</STMTTRN>
+"""
+
+
+def _reference_write_statement(account, outf):
+    # Transaction part of ofx.write_statement() before the rewrite.
+    data = {
+        'accountId': account.account_id,
+        'available': account.available,
+        'balance': account.balance,
+        'bankId': account.bank_id,
+        'currency': account.currency,
+        'reportDate': ofx._to_date(account.report_date),
+        'trnuid': 1,
+    }
+    spool = io.StringIO()
+    first = last = None
+    hashes = {}
+    emitted = 0
+    for operation in account.operations:
+        if first is None:
+            first = operation.timestamp
+        last = operation.timestamp
+        trx = {}
+        trx['description'] = escape(operation.description)
+        if operation.credit:
+            trx['type'] = 'CREDIT'
+            trx['amount'] = str(operation.credit)
+        else:
+            trx['type'] = 'DEBIT'
+            debit = '' if operation.debit is None else operation.debit
+            trx['amount'] = '-%s' % debit
+        trx['timestamp'] = ofx._to_date(operation.timestamp)
+        hsh = sha256(
+            trx['timestamp'].encode('utf-8')
+            + trx['amount'].encode('utf-8')
+            + trx['description'].encode('utf-8')
+        )
+        digest = hsh.hexdigest()
+        if digest in hashes:
+            count = hashes[digest] + 1
+            hashes[digest] = count
+            hsh.update(b'%d' % count)
+        else:
+            hashes[digest] = 1
+        trx['tid'] = hsh.hexdigest()
+        if emitted:
+            spool.write('\n')
+        spool.write(_SINGLE_TRANSACTION % trx)
+        emitted += 1
+
+    data['firstDate'] = ofx._to_date(first)
+    data['lastDate'] = ofx._to_date(last)
+    outf.write('\n'.join((ofx._HEADERS[account.type], ofx._TRANSACTIONS_START)) % data)
+    outf.write(spool.getvalue())
+    # Balances that aren't known are left out, same as ofx.write_statement().
+    outf.write(ofx._TRANSACTIONS_END + '\n')
+    for key, balance in ofx._BALANCES[account.type]:
+        if data[key] is not None:
+            outf.write(balance % data)
+    outf.write(ofx._CLOSING[account.type])
+    return emitted
+
+
+def _account(rows):
+    csv_file = aib._spool_lines(synthetic.checking_lines(rows))
+    account = aib._csv2account(csv_file, aib.Account('benchmark'))
+    operations = list(account.operations)
+    # Cover escaping and duplicate transactions too.
+    operations[1].description = 'M&S <FOOD>'
+    operations[3] = operations[2]
+    account.operations = operations
+    return account
+
+
+def _measure(label, rows, function):
+    outf = io.StringIO()
+    start = time.perf_counter()
+    function(outf)
+    elapsed = time.perf_counter() - start
+    print('%-24s %10.0f transactions/s' % (label, rows / elapsed))
+    return elapsed, outf.getvalue()
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    account = _account(rows)
+    print('%d transactions' % rows)
+    before, expected = _measure(
+        'reference', rows, lambda outf: _reference_write_statement(account, outf)
+    )
+    after, output = _measure(
+        'ofx.write_statement', rows, lambda outf: ofx.write_statement(account, outf)
+    )
+    print('%-24s %10.1fx' % ('speedup', before / after))
+    if output != expected:
+        sys.exit('outputs differ!')
+    print('outputs identical')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""End-to-end benchmark: login, scraping and OFX generation on a replayed session.
+
+Nothing goes to the bank: the whole session is served by replay.ReplayAdapter
+from synthetic pages, with a current account export of given size. Every size
+is run twice, once for time and once, under tracemalloc, for peak memory.
+Run from the repository root:
+
+    python benchmarks/bench_pipeline.py [ROWS ...]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+import synthetic
+
+from aib2ofx import aib, ofx, replay
+
+
+def _exports(rows):
+    return {
+        'CURRENT-001': '\n'.join(synthetic.checking_lines(rows)).encode('utf-8'),
+        'VISA-002': '\n'.join(synthetic.credit_lines(100)).encode('utf-8'),
+    }
+
+
+def run_pipeline(interactions):
+    """Goes through login, get_data and OFX generation for all accounts."""
+    bank = aib.Aib({'regNumber': '12345678', 'pin': '12345'}, {'debug': False})
+    bank.mount(replay.ReplayAdapter(interactions))
+    bank.login()
+    bank.get_data()
+    bank.bye()
+    with open(os.devnull, 'w') as outf:
+        for account in bank.getdata().values():
+            ofx.write_ofx(account, outf)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 100000, 1000000]
+    print('%10s %10s %12s %12s' % ('rows', 'seconds', 'rows/s', 'peak MiB'))
+    for rows in sizes:
+        interactions = synthetic.site_interactions(_exports(rows))
+
+        start = time.perf_counter()
+        run_pipeline(interactions)
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        run_pipeline(interactions)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(
+            '%10d %10.2f %12.0f %12.1f'
+            % (rows, elapsed, rows / elapsed, peak / (1 << 20))
+        )
+
+
+if __name__ == '__main__':
+    main()
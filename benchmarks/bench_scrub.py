@@ -0,0 +1,118 @@
+"""Compares debug log scrubbing: three passes of regexes vs aib.CleansingFormatter.
+
+Both scrub the same synthetic transactions page, which has to come out the
+same. Logging throughput is measured from the caller's point of view, with
+pages written to a file directly and through the queue used in debug mode.
+Run from the repository root:
+
+    python benchmarks/bench_scrub.py [ROWS]
+"""
+
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import tempfile
+import time
+
+from aib2ofx import aib
+
+_AMOUNT_RE = re.compile(r'(?:\d+,)*\d+\.\d+(?: DR)?')
+_DATE_RE = re.compile(r'\d\d/\d\d/\d\d')
+_DESCRIPTION_RE = re.compile('<td>(?!dd/mm/yy).+</td>')
+
+_ROW = """<tr>
+<td>%02d/%02d/%02d</td>
+<td>VDC-SHOP %d</td>
+<td class="amount">%d,%03d.%02d DR</td>
+<td class="amount">%d.%02d</td>
+</tr>
+"""
+
+
+def _reference_scrub(text):
+    # aib.CleansingFormatter.scrub() before the rewrite.
+    tmp = _AMOUNT_RE.sub('X.XX', text)
+    tmp = _DATE_RE.sub('dd/mm/yy', tmp)
+    return _DESCRIPTION_RE.sub('<td>dummy description</td>', tmp)
+
+
+def _page(rows):
+    body = ''.join(
+        _ROW
+        % (
+            row % 28 + 1,
+            row % 12 + 1,
+            row % 100,
+            row,
+            row % 10,
+            row % 1000,
+            row % 100,
+            row % 5000,
+            row % 100,
+        )
+        for row in range(rows)
+    )
+    return '<html><body><table>\n%s</table></body></html>' % body
+
+
+def _measure(label, size, function):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    print('%-32s %10.1f MB/s' % (label, size / elapsed / 1e6))
+    return result
+
+
+def _logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    page = _page(rows)
+    size = len(page)
+    print('%d rows, %.1f MB page' % (rows, size / 1e6))
+
+    formatter = aib.CleansingFormatter()
+    expected = _measure('three passes', size, lambda: _reference_scrub(page))
+    scrubbed = _measure('single pass', size, lambda: formatter.scrub(page))
+    if scrubbed != expected:
+        sys.exit('outputs differ!')
+    print('outputs identical')
+
+    pages = 20
+    directory = tempfile.mkdtemp(prefix='aib2ofx_bench_')
+    direct = logging.FileHandler(os.path.join(directory, 'direct.log'), 'w')
+    direct.setFormatter(aib.CleansingFormatter('%(asctime)s\n%(message)s'))
+    logger = _logger('bench_direct', direct)
+    _measure(
+        'logging, direct',
+        size * pages,
+        lambda: [logger.debug('Page:\n%s', page) for _ in range(pages)],
+    )
+    direct.close()
+
+    queued = logging.FileHandler(os.path.join(directory, 'queued.log'), 'w')
+    queued.setFormatter(aib.CleansingFormatter('%(asctime)s\n%(message)s'))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, queued)
+    listener.start()
+    logger = _logger('bench_queued', logging.handlers.QueueHandler(records))
+    _measure(
+        'logging, queued (caller)',
+        size * pages,
+        lambda: [logger.debug('Page:\n%s', page) for _ in range(pages)],
+    )
+    _measure('logging, queued (drain)', size * pages, listener.stop)
+    queued.close()
+
+
+if __name__ == '__main__':
+    main()
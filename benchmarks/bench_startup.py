@@ -0,0 +1,98 @@
+"""Measures cold start of aib2ofx commands that never go online.
+
+Every command runs a few times in a fresh interpreter, under
+python -X importtime; the best run counts. Import time of each command has to
+stay within the budget, and modules only needed for talking to the bank must
+not be imported at all. Run from the repository root:
+
+    python benchmarks/bench_startup.py [RUNS]
+"""
+
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+
+# Import time budget of a command that doesn't go online, in milliseconds.
+# Importing mechanicalsoup alone takes about as much; the whole of aib2ofx.cli
+# used to take three times that.
+_BUDGET_MS = 120
+
+# Modules that only scraping needs.
+_ONLINE_MODULES = (
+    'asyncio',
+    'bs4',
+    'dateutil',
+    'httpx',
+    'mechanicalsoup',
+    'pyarrow',
+    'requests',
+    'urllib3',
+)
+
+_IMPORTTIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+_RUN_CLI = 'import sys; from aib2ofx import cli; sys.argv[0] = "aib2ofx"; cli.main()'
+
+
+def _run(args):
+    """Runs aib2ofx with args, returns wall time, import time and modules."""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _RUN_CLI] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    wall = time.perf_counter() - start
+    imported = 0
+    modules = set()
+    for match in _IMPORTTIME_RE.finditer(result.stderr):
+        _, cumulative, indent, module = match.groups()
+        modules.add(module)
+        # Top level imports include all of their own.
+        if len(indent) == 1:
+            imported += int(cumulative)
+    return wall, imported / 1000, modules
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    workdir = tempfile.mkdtemp(prefix='aib2ofx_bench_')
+    with open(os.path.join(workdir, 'user_current_1.csv'), 'w') as outf:
+        outf.write('\n'.join(synthetic.checking_lines(100)))
+    commands = {
+        '--help': ['--help'],
+        'convert --help': ['convert', '--help'],
+        'convert': ['convert', '-q', '--force', workdir],
+    }
+
+    over = False
+    print('%-16s %10s %10s   budget %d ms' % ('command', 'wall', 'imports', _BUDGET_MS))
+    for label, args in commands.items():
+        results = [_run(args) for _ in range(runs)]
+        wall = min(result[0] for result in results)
+        imported = min(result[1] for result in results)
+        online = sorted(
+            {module.split('.')[0] for module in results[0][2]}.intersection(
+                _ONLINE_MODULES
+            )
+        )
+        print('%-16s %7.0f ms %7.0f ms' % (label, wall * 1000, imported))
+        if imported > _BUDGET_MS:
+            print('  over budget!')
+            over = True
+        if online:
+            print('  imports modules for going online: %s' % ', '.join(online))
+            over = True
+    if over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""Synthetic AIB CSV exports for benchmarks."""
+
+import datetime
+import random
+
+CHECKING_HEADER = (
+    'Posted Account, Posted Transactions Date, Description1, Description2, '
+    'Description3, Debit Amount, Credit Amount, Balance, Posted Currency, '
+    'Transaction Type'
+)
+
+CREDIT_HEADER = (
+    'Masked Card Number, Posted Transactions Date, Description, Debit Amount, '
+    'Credit Amount, Posted Currency, Transaction Type'
+)
+
+_SHOPS = ['VDP-TESCO STORES', 'VDC-CENTRA', 'D/D ELECTRIC IRELAND', 'ATM DUBLIN 2']
+
+
+def _amount(cents):
+    return '%s%d.%02d' % ('-' if cents < 0 else '', *divmod(abs(cents), 100))
+
+
+def checking_lines(rows, seed=0, per_day=5):
+    """Yields lines of a current account export with given number of rows."""
+    rnd = random.Random(seed)
+    day = datetime.date(2000, 1, 1)
+    balance = 100000
+    yield CHECKING_HEADER
+    for row in range(rows):
+        if row and row % per_day == 0:
+            day += datetime.timedelta(days=1)
+        cents = rnd.randint(1, 50000)
+        if rnd.random() < 0.8:
+            debit, credit = _amount(cents), ''
+            balance -= cents
+        else:
+            debit, credit = '', _amount(cents)
+            balance += cents
+        yield (
+            '"935-123-45678901", "%s", "%s", "%s", "", "%s", "%s", "%s", "EUR", "%s"'
+            % (
+                day.strftime('%d/%m/%Y'),
+                rnd.choice(_SHOPS),
+                'REF%d' % rnd.randint(0, 999) if rnd.random() < 0.3 else '',
+                debit,
+                credit,
+                _amount(balance),
+                'Debit' if debit else 'Credit',
+            )
+        )
+
+
+def credit_lines(rows, seed=0, per_day=5):
+    """Yields lines of a credit card export with given number of rows."""
+    rnd = random.Random(seed)
+    day = datetime.date(2000, 1, 1)
+    yield CREDIT_HEADER
+    for row in range(rows):
+        if row and row % per_day == 0:
+            day += datetime.timedelta(days=1)
+        cents = rnd.randint(1, 50000)
+        yield '"************1234", "%s", "%s", "%s", "", "EUR", "Debit"' % (
+            day.strftime('%d/%m/%Y'),
+            rnd.choice(_SHOPS) + ' ' + rnd.choice(['DUBLIN', 'CORK']),
+            _amount(cents),
+        )
+
+
+_BASE = '/inet/roi/'
+
+_PAGE = '<!DOCTYPE html><html><head><title>AIB</title></head><body>%s</body></html>'
+
+_HISTORICAL = """<h1>Historical Transactions</h1>
+<form id="hForm" method="post" action="%(base)shistoricaltransactions.htm">
+<select name="dsAccountIndex">%(options)s</select>
+</form>
+<form id="historicalTransactionsCommand" method="post" action="%(base)shistoricaltransactions.htm">
+<input type="hidden" name="export" value="true"/>
+<input type="submit" name="exportButton" value="Export"/>
+</form>
+<form id="historicaltransactions_form_id" method="post" action="%(base)shistoricaltransactions.htm">
+</form>
+<form id="formLogout" method="post" action="%(base)slogout.htm"></form>
+"""
+
+
+def _html(body):
+    return _PAGE % body
+
+
+def _interaction(method, path, body, status=200, content_type='text/html'):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return {
+        'method': method,
+        'path': path,
+        'request': '',
+        'status': status,
+        'reason': '',
+        'headers': {'Content-Type': content_type + '; charset=utf-8'},
+        'body': body,
+    }
+
+
+def site_interactions(exports):
+    """Returns interactions of a whole session, for replay.ReplayAdapter.
+
+    exports maps account names to bodies of their CSV exports. The flow
+    mirrors aib.Aib: login with 2FA approved on first poll, historical
+    listing, export of every account, logout.
+    """
+    login = _BASE + 'login.htm'
+    buttons = ''.join(
+        '<button class="account-button"><div class="account-name">%s</div>'
+        '<span class="a-amount">1,234.56</span></button>' % name
+        for name in exports
+    )
+    options = ''.join(
+        '<option value="%d">%s</option>' % (number, name)
+        for number, name in enumerate(exports)
+    )
+    historical = _html(_HISTORICAL % {'base': _BASE, 'options': options})
+    confirm = _html(
+        '<form id="historicalTransactionsCommand" method="post" '
+        'action="%sexport.htm"></form>'
+        '<form id="historicaltransactions_form_id" method="post" '
+        'action="%shistoricaltransactions.htm"></form>' % (_BASE, _BASE)
+    )
+
+    interactions = [
+        _interaction(
+            'GET',
+            login,
+            _html(
+                '<form id="loginCiamForm" method="post" action="%s">'
+                '<input type="submit" value="Continue"/></form>' % login
+            ),
+        ),
+        _interaction(
+            'POST',
+            login,
+            _html(
+                "<script>window.location = 'https:\\/\\/onlinebanking.aib.ie"
+                "\\/inet\\/roi\\/ciam.htm';\nencodedPostParams = 'cGFyYW1z';</script>"
+            ),
+            status=401,
+        ),
+        _interaction(
+            'GET',
+            _BASE + 'ciam.htm',
+            _html(
+                '<form method="post" action="%sciam.htm">'
+                '<input name="pf.username"/><input name="pf.pass" type="password"/>'
+                '<input type="submit" value="Log in"/></form>' % _BASE
+            ),
+        ),
+        _interaction(
+            'POST',
+            _BASE + 'ciam.htm',
+            _html(
+                '<form id="finalizeForm" method="post" action="%sfinalize.htm">'
+                '</form>' % _BASE
+            ),
+        ),
+        _interaction(
+            'POST', _BASE + 'finalize.htm', 'approved', content_type='text/plain'
+        ),
+        _interaction(
+            'POST',
+            _BASE + 'finalize.htm',
+            _html(
+                '<form method="post" action="%sauthorize.htm"></form>'
+                "<script>state.value = 'c3RhdGU';\nencodedNonce = 'bm9uY2U';</script>"
+                % _BASE
+            ),
+        ),
+        _interaction(
+            'POST',
+            _BASE + 'authorize.htm',
+            _html('<form method="post" action="%saccounts.htm"></form>' % _BASE),
+        ),
+        _interaction(
+            'POST',
+            _BASE + 'accounts.htm',
+            _html(
+                '<h1>My Accounts</h1>%s'
+                '<form id="statement_form_id" method="post" action="%srecent.htm">'
+                '</form>' % (buttons, _BASE)
+            ),
+        ),
+        _interaction(
+            'POST',
+            _BASE + 'recent.htm',
+            _html(
+                '<form id="historicalTransactionsCommand" method="post" '
+                'action="%shistoricaltransactions.htm"></form>' % _BASE
+            ),
+        ),
+        _interaction('POST', _BASE + 'historicaltransactions.htm', historical),
+    ]
+    for body in exports.values():
+        interactions += [
+            _interaction('POST', _BASE + 'historicaltransactions.htm', historical),
+            _interaction('POST', _BASE + 'historicaltransactions.htm', confirm),
+            _interaction('POST', _BASE + 'export.htm', body, content_type='text/csv'),
+            _interaction('POST', _BASE + 'historicaltransactions.htm', historical),
+        ]
+    interactions.append(
+        _interaction(
+            'POST',
+            _BASE + 'logout.htm',
+            _html('<h1>Logged Out</h1>'),
+        )
+    )
+    return interactions